@@ -0,0 +1,395 @@
+"""
+Seekable block compressed analyser files
+
+An analyser file can be kept compressed on disk as "<name>.csv.gz". The file is written as a sequence of
+independent gzip members (blocks) of about block_size bytes of rows each, so it can still be read by gzip or zcat.
+Every block records its compressed and uncompressed size in an extra field of its gzip header, so the
+offsets of the blocks are found by reading the headers only and a read at an offset of the uncompressed data
+(e.g. an offset of the index, see analyser_index.py) only decompresses the blocks containing it.
+The decompressed blocks are kept in a cache bounded by their size.
+
+Files compressed by another tool (e.g. plain gzip) can't be read at an offset without decompressing everything
+before it, so they are refused. They are converted into blocks with analyser_blocks.py.
+
+structure of a block (see RFC 1952):
+gzip header with FEXTRA: subfield "AB" with the compressed size of the block and the size of its rows (uint32 each)
+deflate data, crc32, size of the rows
+
+usage:
+python analyser_blocks.py <analyser file> ...
+    compresses the files and removes the originals (like gzip). Files compressed by gzip are recompressed in place
+"""
+import bisect
+import gzip
+import io
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from array import array
+from collections import OrderedDict
+
+import metrics
+
+compressed_extension = ".gz"
+
+# the amount of bytes of rows compressed into one block
+block_size = 1024 * 1024
+compression_level = 6
+# the maximum amount of bytes of the cached decompressed blocks
+cache_size = 32 * 1024 * 1024
+
+block_subfield = b'AB'
+block_header_format = '<4BIBBH2sHII'
+
+# block tables of the compressed files (path -> BlockTable)
+_tables = {}
+# decompressed blocks ((path, compressed offset) -> bytes), the least recently used first
+_blocks = OrderedDict()
+_blocks_size = 0
+_blocks_lock = threading.Lock()
+
+
+def is_compressed(path):
+    """
+    :param path: the path of an analyser file
+    :type path: str
+
+    :return: True if the file is compressed
+    :rtype: bool
+    """
+    return path.endswith(compressed_extension)
+
+
+class BlockTable(object):
+    """
+    The offsets of the blocks of a compressed file
+    """
+    __slots__ = ('path', 'size', 'mtime', 'offsets', 'data_offsets')
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        # offset of every block in the file and the end of the last block
+        self.offsets = array('q', [0])
+        # offset of the rows of every block in the uncompressed data and the end of the rows of the last block
+        self.data_offsets = array('q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_data_size(self):
+        """
+        :return: the size of the uncompressed data
+        :rtype: int
+        """
+        return self.data_offsets[-1]
+
+    def find(self, offset):
+        """
+        :param offset: an offset of the uncompressed data
+        :type offset: int
+
+        :return: the block containing the offset
+        :rtype: int
+        """
+        return bisect.bisect_right(self.data_offsets, offset) - 1
+
+
+def read_block_header(compressed_file):
+    """
+    :param compressed_file: the compressed file at the start of a block
+    :type compressed_file: io.BufferedReader
+
+    :return: the compressed size and the size of the rows of the block or None if the header contains no
+        block sizes or is incomplete
+    :rtype: tuple[int, int]
+    """
+    header = compressed_file.read(12)
+    if (len(header) < 12 or header[:3] != b'\x1f\x8b\x08' or not header[3] & 4):
+        return None
+    extra = compressed_file.read(struct.unpack('<H', header[10:12])[0])
+    position = 0
+    while (position + 4 <= len(extra)):
+        subfield_id, length = extra[position:position + 2], struct.unpack('<H', extra[position + 2:position + 4])[0]
+        if (subfield_id == block_subfield and length == 8):
+            return struct.unpack('<II', extra[position + 4:position + 12])
+        position += 4 + length
+    return None
+
+
+def read_block_table(path, table=None):
+    """
+    Read the headers of the blocks of a compressed file
+
+    :param path: the path of the compressed file
+    :param table: the table of the file before it grew. Only the headers of the new blocks are read
+    :type path: str
+    :type table: BlockTable
+
+    :raises ValueError: if the file isn't block compressed
+
+    :return: the block table of the file
+    :rtype: BlockTable
+    """
+    stat = os.stat(path)
+    if (table is None):
+        table = BlockTable(path, stat.st_size, stat.st_mtime_ns)
+    table.size = stat.st_size
+    table.mtime = stat.st_mtime_ns
+
+    with open(path, 'rb') as compressed_file:
+        offset = table.offsets[-1]
+        while (offset < stat.st_size):
+            compressed_file.seek(offset)
+            sizes = read_block_header(compressed_file)
+            if (sizes is None):
+                if (offset == 0):
+                    raise ValueError("%s isn't block compressed, recompress it with python analyser_blocks.py %s" %
+                                     (path, path))
+                else:
+                    logging.error("Block at %d of %s has no block sizes, ignoring the rest of the file", offset, path)
+                break
+            if (offset + sizes[0] > stat.st_size):
+                # the block is still written
+                break
+            offset += sizes[0]
+            table.offsets.append(offset)
+            table.data_offsets.append(table.data_offsets[-1] + sizes[1])
+    return table
+
+
+def get_block_table(path):
+    """
+    Get the up to date block table of a compressed file. If the file only grew, only the new blocks are read
+
+    :param path: the path of the compressed file
+    :type path: str
+
+    :return: the block table
+    :rtype: BlockTable
+    """
+    stat = os.stat(path)
+    table = _tables.get(path)
+    if (table is not None and table.size == stat.st_size and table.mtime == stat.st_mtime_ns):
+        return table
+
+    if (table is not None and table.size < stat.st_size):
+        table = read_block_table(path, table)
+    else:
+        if (table is not None):
+            clear_blocks(path)
+        table = read_block_table(path)
+    _tables[path] = table
+    return table
+
+
+def clear_blocks(path):
+    """
+    Remove the cached blocks of a file
+
+    :param path: the path of the compressed file
+    :type path: str
+    """
+    global _blocks_size
+    with _blocks_lock:
+        for key in [key for key in _blocks if key[0] == path]:
+            _blocks_size -= len(_blocks.pop(key))
+
+
+def read_block(compressed_file, table, i):
+    """
+    :param compressed_file: the opened compressed file
+    :param table: the block table of the file
+    :param i: the number of the block
+    :type compressed_file: io.BufferedReader
+    :type table: BlockTable
+    :type i: int
+
+    :return: the rows of the block
+    :rtype: bytes
+    """
+    global _blocks_size
+    key = (table.path, table.offsets[i])
+    with _blocks_lock:
+        data = _blocks.get(key)
+        if (data is not None):
+            _blocks.move_to_end(key)
+    if (data is not None):
+        metrics.count("analyser_blocks.cache_hits")
+        return data
+
+    compressed_file.seek(table.offsets[i])
+    compressed = compressed_file.read(table.offsets[i + 1] - table.offsets[i])
+    data = zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+    metrics.count("analyser_blocks.decompressed")
+    metrics.count("analyser_blocks.bytes_decompressed", len(data))
+
+    if (len(data) <= cache_size):
+        with _blocks_lock:
+            if (key not in _blocks):
+                _blocks[key] = data
+                _blocks_size += len(data)
+            while (_blocks_size > cache_size):
+                _, evicted = _blocks.popitem(last=False)
+                _blocks_size -= len(evicted)
+    return data
+
+
+class BlockReader(io.RawIOBase):
+    """
+    Reads the uncompressed data of a compressed file at any offset
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the compressed file
+        :type path: str
+        """
+        super().__init__()
+        self.name = path
+        self.table = get_block_table(path)
+        self.position = 0
+        self._file = open(path, 'rb')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset += self.position
+        elif (whence == io.SEEK_END):
+            offset += self.table.get_data_size()
+        if (offset < 0):
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        if (self.position >= self.table.get_data_size()):
+            return 0
+        i = self.table.find(self.position)
+        data = read_block(self._file, self.table, i)
+        start = self.position - self.table.data_offsets[i]
+        length = min(len(buffer), len(data) - start)
+        buffer[:length] = memoryview(data)[start:start + length]
+        self.position += length
+        return length
+
+    def close(self):
+        if (not self.closed):
+            self._file.close()
+        super().close()
+
+
+def open_data_file(path, mode='rb', newline=None, buffering=-1):
+    """
+    Open an analyser file for reading, compressed files are decompressed while they are read
+
+    :param path: the path of the analyser file
+    :param mode: 'rb' or 'r'
+    :param newline: the newline mode of the text (see open)
+    :param buffering: the size of the read buffer (-1 for the default)
+    :type path: str
+    :type mode: str
+    :type newline: str
+    :type buffering: int
+
+    :return: the opened file. Its offsets are the offsets of the uncompressed data
+    :rtype: io.BufferedReader|io.TextIOWrapper
+    """
+    if (not is_compressed(path)):
+        if (mode == 'rb'):
+            return open(path, mode, buffering=buffering)
+        return open(path, mode, buffering=buffering, newline=newline)
+
+    binary_file = io.BufferedReader(BlockReader(path), io.DEFAULT_BUFFER_SIZE if (buffering < 0) else buffering)
+    if (mode == 'rb'):
+        return binary_file
+    return io.TextIOWrapper(binary_file, newline=newline)
+
+
+def get_data_size(path):
+    """
+    :param path: the path of an analyser file
+    :type path: str
+
+    :return: the size of the uncompressed data of the file
+    :rtype: int
+    """
+    if (is_compressed(path)):
+        return get_block_table(path).get_data_size()
+    return os.path.getsize(path)
+
+
+def write_block(compressed_file, data):
+    """
+    Compress rows into a block
+
+    :param compressed_file: the compressed file opened for writing
+    :param data: the rows
+    :type compressed_file: io.BufferedWriter
+    :type data: bytes
+    """
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    header_size = struct.calcsize(block_header_format)
+    compressed_size = header_size + len(deflated) + 8
+    # FLG = FEXTRA, MTIME = 0, XFL = 0, OS = unknown, XLEN = 12
+    compressed_file.write(struct.pack(block_header_format, 0x1f, 0x8b, 8, 4, 0, 0, 255, 12, block_subfield, 8,
+                                      compressed_size, len(data)))
+    compressed_file.write(deflated)
+    compressed_file.write(struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff))
+
+
+def compress_file(path, target=None):
+    """
+    Compress an analyser file into blocks ending at row boundaries. A file compressed by gzip is decompressed
+    while it is read
+
+    :param path: the path of the analyser file
+    :param target: the path of the compressed file (default the path with compressed_extension, a compressed
+        file is replaced)
+    :type path: str
+    :type target: str
+
+    :return: the path of the compressed file
+    :rtype: str
+    """
+    if (target is None):
+        target = path if (is_compressed(path)) else path + compressed_extension
+    temp_path = target + ".tmp"
+    blocks = 0
+    with (gzip.open(path, 'rb') if (is_compressed(path)) else open(path, 'rb')) as csv_file, \
+            open(temp_path, 'wb') as compressed_file:
+        while True:
+            data = csv_file.read(block_size)
+            if (len(data) == 0):
+                break
+            if (not data.endswith(b'\n')):
+                data += csv_file.readline()
+            write_block(compressed_file, data)
+            blocks += 1
+    os.replace(temp_path, target)
+    logging.debug("Compressed %s into %d blocks", path, blocks)
+    return target
+
+
+if (__name__ == "__main__"):
+    logging.basicConfig(level=logging.DEBUG)
+    if (len(sys.argv) < 2):
+        print(__doc__)
+        sys.exit(1)
+    for analyser_path in sys.argv[1:]:
+        if (compress_file(analyser_path) != analyser_path):
+            os.remove(analyser_path)
@@ -0,0 +1,226 @@
+"""
+Parallel parsing of large analyser csv files
+
+A file is split into byte ranges of about the same size. Every range is moved to the next image boundary
+(the first row whose id or datetime differs from the row before), so no image is split between two ranges.
+The ranges are parsed by a pool of processes into compact arrays and merged in the order of the file.
+
+structure of a parsed file (ParsedFile):
+image columns: id, datetime in microseconds since epoch, byte offset, row count, locus count (array('q') each),
+               recipe (list[str])
+locus columns (only if the loci are parsed): number, classification, color_r, color_g, color_b, height
+               (array('i') each), spectra (array('f') with spectra_count values per locus)
+"""
+import csv
+import datetime
+import logging
+import os
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+from analyser_blocks import get_data_size, open_data_file
+from timings import to_microseconds
+
+spectra_count = 235
+# the fields of a row of an analyser file: the first spectra value and the locus columns (number, classification,
+# color_r, color_g, color_b, height)
+spectra_start = 5
+locus_fields = (2, 261, 262, 263, 264, 265)
+
+# files smaller than this are parsed by a single process
+min_parallel_size = 16 * 1024 * 1024
+# the amount of processes (None for the amount of cpus)
+parse_processes = None
+
+
+class ParsedFile(object):
+    """
+    The images (and loci) of an analyser file or of a range of it
+    """
+    __slots__ = ('ids', 'datetimes', 'offsets', 'rows', 'locus_counts', 'recipes', 'columns', 'spectra')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.datetimes = array('q')
+        self.offsets = array('q')
+        self.rows = array('q')
+        self.locus_counts = array('q')
+        self.recipes = []
+        self.columns = [array('i') for _ in range(6)]
+        self.spectra = array('f')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, other):
+        """
+        Append the images of the following range of the file
+
+        :param other: the parsed range
+        :type other: ParsedFile
+        """
+        for name in ('ids', 'datetimes', 'offsets', 'rows', 'locus_counts', 'recipes', 'spectra'):
+            getattr(self, name).extend(getattr(other, name))
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+
+
+def get_line_key(line):
+    """
+    :param line: a raw row of an analyser file
+    :type line: bytes
+
+    :return: the id and datetime of the row or None if it is no complete row
+    :rtype: tuple[bytes, bytes]
+    """
+    fields = line.split(b';', 4)
+    if (len(fields) < 5 or not line.endswith(b'\n')):
+        return None
+    return fields[0], fields[1]
+
+
+def find_image_boundary(csv_file, offset):
+    """
+    Find the first image starting at or after a byte offset
+
+    :param csv_file: the file opened in binary mode
+    :param offset: the byte offset
+    :type csv_file: io.BufferedReader
+    :type offset: int
+
+    :return: the byte offset of the first row of the image
+    :rtype: int
+    """
+    if (offset == 0):
+        return 0
+
+    # continue from the start of the row before the offset
+    csv_file.seek(offset - 1)
+    position = offset - 1 + len(csv_file.readline())
+    key = None
+    while True:
+        line = csv_file.readline()
+        if (not line.endswith(b'\n')):
+            return position
+        line_key = get_line_key(line)
+        if (key is not None and line_key != key):
+            return position
+        key = line_key
+        position += len(line)
+
+
+def get_ranges(path, count):
+    """
+    Split a file into byte ranges starting at image boundaries
+
+    :param path: the path of the analyser file
+    :param count: the amount of ranges
+    :type path: str
+    :type count: int
+
+    :return: tuples (start, end) of the ranges
+    :rtype: list[tuple[int, int]]
+    """
+    size = get_data_size(path)
+    with open_data_file(path, 'rb') as csv_file:
+        boundaries = sorted(set([find_image_boundary(csv_file, size * i // count) for i in range(count)] + [size]))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_range(path, start, end, loci=True):
+    """
+    Parse the images of a range of an analyser file. Rows still being written (without line break) are skipped
+
+    :param path: the path of the analyser file
+    :param start: the byte offset of the first image
+    :param end: the byte offset after the range
+    :param loci: False to only collect the images without parsing the loci
+    :type path: str
+    :type start: int
+    :type end: int
+    :type loci: bool
+
+    :return: the images of the range
+    :rtype: ParsedFile
+    """
+    parsed = ParsedFile()
+    key = None
+    with open_data_file(path, 'rb') as csv_file:
+        csv_file.seek(start)
+        offset = start
+        while (offset < end):
+            line = csv_file.readline()
+            if (not line.endswith(b'\n')):
+                break
+            line_offset = offset
+            offset += len(line)
+
+            if (loci):
+                if (b'"' in line):
+                    row = next(csv.reader([line.decode()], delimiter=';'))
+                else:
+                    row = line.decode().rstrip('\r\n').split(';')
+                if (len(row) < 267):
+                    continue
+                line_key = (row[0], row[1])
+            else:
+                line_key = get_line_key(line)
+                if (line_key is None):
+                    continue
+                row = line.split(b';', 4)
+
+            if (line_key == key):
+                parsed.rows[-1] += 1
+            else:
+                key = line_key
+                parsed.ids.append(int(row[0]))
+                datetime_string = row[1] if loci else row[1].decode()
+                parsed.datetimes.append(to_microseconds(
+                    datetime.datetime.strptime(datetime_string, "%Y-%m-%d %H:%M:%S.%f")))
+                parsed.offsets.append(line_offset)
+                parsed.rows.append(1)
+                parsed.locus_counts.append(int(row[3]))
+                if (loci):
+                    parsed.recipes.append(row[266])
+
+            if (loci):
+                for column, field_no in zip(parsed.columns, locus_fields):
+                    column.append(int(row[field_no]))
+                parsed.spectra.extend(map(float, row[spectra_start:spectra_start + spectra_count]))
+    return parsed
+
+
+def parse_file(path, loci=True, processes=None):
+    """
+    Parse an analyser file, large files are parsed in parallel by multiple processes
+
+    :param path: the path of the analyser file
+    :param loci: False to only collect the images without parsing the loci
+    :param processes: the amount of processes (default parse_processes)
+    :type path: str
+    :type loci: bool
+    :type processes: int
+
+    :return: the images of the file
+    :rtype: ParsedFile
+    """
+    if (processes is None):
+        processes = parse_processes or os.cpu_count() or 1
+    size = get_data_size(path)
+    with metrics.span("analyser.parse"):
+        if (processes < 2 or size < min_parallel_size):
+            parsed = parse_range(path, 0, size, loci)
+        else:
+            ranges = get_ranges(path, processes)
+            logging.debug("Parsing %s in %d ranges", path, len(ranges))
+            parsed = ParsedFile()
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(parse_range, path, start, end, loci) for start, end in ranges]
+                for future in futures:
+                    parsed.extend(future.result())
+    metrics.count("analyser.bytes_read", size)
+    metrics.count("analyser.rows_scanned", sum(parsed.rows))
+    return parsed
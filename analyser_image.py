@@ -0,0 +1,176 @@
+"""
+Compact representation of analyser images
+
+The loci of an image are kept in columns instead of a dictionary per locus: the integer columns in
+array('i') and the spectra of all loci in a single array('f') (float32, spectra_count values per locus).
+An image can still be used like the dictionary returned before (see synchsensordata.access_csv_data):
+image['loci'] is a sequence of loci and every locus is a read only mapping of its columns.
+"""
+from array import array
+from collections.abc import Mapping, Sequence
+
+from analyser_chunks import locus_fields, spectra_count, spectra_start
+
+image_keys = ('id', 'datetime', 'locus_count', 'recipe', 'loci')
+locus_columns = ('number', 'classification', 'color_r', 'color_g', 'color_b', 'height')
+
+
+class AnalyserImage(Mapping):
+    """
+    An analyser image with the loci read so far
+    """
+    __slots__ = ('id', 'datetime', 'locus_count', 'recipe', 'columns', 'spectra')
+
+    def __init__(self, image_id, image_datetime, locus_count, recipe):
+        """
+        :param image_id: the id of the image
+        :param image_datetime: the time the image was captured
+        :param locus_count: the amount of loci of the complete image
+        :param recipe: the recipe of the image
+        :type image_id: int
+        :type image_datetime: datetime.datetime
+        :type locus_count: int
+        :type recipe: str
+        """
+        self.id = image_id
+        self.datetime = image_datetime
+        self.locus_count = locus_count
+        self.recipe = recipe
+        self.columns = [array('i') for _ in locus_columns]
+        self.spectra = array('f')
+
+    def __getitem__(self, key):
+        if (key == 'loci'):
+            return self.loci
+        if (key in image_keys):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(image_keys)
+
+    def __len__(self):
+        return len(image_keys)
+
+    def __repr__(self):
+        return "AnalyserImage(id=%r, datetime=%r, locus_count=%r, loci=%d)" % (
+            self.id, self.datetime, self.locus_count, len(self.loci))
+
+    @property
+    def loci(self):
+        """
+        :return: the loci read so far
+        :rtype: Loci
+        """
+        return Loci(self)
+
+    def is_complete(self):
+        """
+        :return: True if all loci of the image have been read
+        :rtype: bool
+        """
+        return len(self.columns[0]) == self.locus_count
+
+    def append_row(self, row):
+        """
+        Add the locus of a row of an analyser file
+
+        :param row: the row
+        :type row: list[str]
+        """
+        for column, field_no in zip(self.columns, locus_fields):
+            column.append(int(row[field_no]))
+        self.spectra.extend(map(float, row[spectra_start:spectra_start + spectra_count]))
+
+    def extend(self, other):
+        """
+        Add the loci of the rest of the image (e.g. read from the following file)
+
+        :param other: the rest of the image
+        :type other: AnalyserImage
+        """
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+        self.spectra.extend(other.spectra)
+
+    def get_size(self):
+        """
+        :return: the approximate amount of bytes the loci occupy
+        :rtype: int
+        """
+        return sum(len(column) * column.itemsize for column in self.columns) + len(self.spectra) * 4
+
+    def to_dict(self):
+        """
+        :return: the image as plain dictionary with a dictionary per locus and the spectra as lists
+        :rtype: dict
+        """
+        image = dict((key, getattr(self, key)) for key in image_keys[:-1])
+        image['loci'] = [locus.to_dict() for locus in self.loci]
+        return image
+
+
+class Loci(Sequence):
+    """
+    The loci of an image
+    """
+    __slots__ = ('image',)
+
+    def __init__(self, image):
+        self.image = image
+
+    def __len__(self):
+        return len(self.image.columns[0])
+
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            return [Locus(self.image, j) for j in range(*i.indices(len(self)))]
+        if (i < 0):
+            i += len(self)
+        if (i < 0 or i >= len(self)):
+            raise IndexError("locus index out of range")
+        return Locus(self.image, i)
+
+    def __eq__(self, other):
+        if (not isinstance(other, Sequence)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if (equal is NotImplemented) else not equal
+
+
+class Locus(Mapping):
+    """
+    A read only view of a single locus of an image
+    """
+    __slots__ = ('image', 'i')
+
+    def __init__(self, image, i):
+        self.image = image
+        self.i = i
+
+    def __getitem__(self, key):
+        if (key == 'spectra'):
+            return self.image.spectra[self.i * spectra_count:(self.i + 1) * spectra_count]
+        try:
+            return self.image.columns[locus_columns.index(key)][self.i]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(locus_columns + ('spectra',))
+
+    def __len__(self):
+        return len(locus_columns) + 1
+
+    def to_dict(self):
+        """
+        :return: the locus as plain dictionary with the spectra as list
+        :rtype: dict
+        """
+        locus = dict(zip(locus_columns, (column[self.i] for column in self.image.columns)))
+        locus['spectra'] = self['spectra'].tolist()
+        return locus
+
@@ -0,0 +1,261 @@
+"""
+Byte offset index for analyser csv files
+
+The index of an analyser file is saved in the hidden directory ".index" next to the file and is
+only rebuilt if the size or the modification time of the analyser file changed. If the file only grew,
+just the appended data is indexed.
+
+structure of an index file:
+#;file size;file mtime in ns
+image id;image datetime;byte offset;row count;locus count
+...
+
+The image datetime is stored in the normalized format "%Y-%m-%d %H:%M:%S.%f" so the strings can
+be compared directly.
+"""
+import bisect
+import csv
+import datetime
+import logging
+import os
+
+from itertools import islice
+from os.path import basename, dirname, join
+
+import metrics
+
+from analyser_blocks import get_data_size, open_data_file
+from analyser_chunks import parse_file, parse_range
+from timings import from_microseconds
+
+index_directory = ".index"
+datetime_format = "%Y-%m-%d %H:%M:%S.%f"
+
+# loaded indexes (path -> AnalyserIndex)
+_indexes = {}
+
+
+class AnalyserIndex(object):
+    """
+    The images of a single analyser file in the order they are written in the file
+    """
+    __slots__ = ('path', 'size', 'mtime', 'ids', 'datetimes', 'offsets', 'rows', 'locus_counts')
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.ids = []
+        self.datetimes = []
+        self.offsets = []
+        self.rows = []
+        self.locus_counts = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, image_id, image_datetime, offset, rows, locus_count):
+        self.ids.append(image_id)
+        self.datetimes.append(image_datetime)
+        self.offsets.append(offset)
+        self.rows.append(rows)
+        self.locus_counts.append(locus_count)
+
+    def truncate(self, length):
+        """
+        Remove all images but the first ones
+
+        :param length: the amount of images to keep
+        :type length: int
+        """
+        del self.ids[length:]
+        del self.datetimes[length:]
+        del self.offsets[length:]
+        del self.rows[length:]
+        del self.locus_counts[length:]
+
+    def is_complete(self, i):
+        """
+        :param i: the position of the image in the index
+        :type i: int
+
+        :return: True if all loci of the image are in this file
+        :rtype: bool
+        """
+        return self.rows[i] == self.locus_counts[i]
+
+    def find_closest(self, timestamp):
+        """
+        Binary search the image closest to a timestamp
+
+        :param timestamp: the timestamp to search for
+        :type timestamp: datetime.datetime
+
+        :return: the position of the closest image in the index or None if the index is empty
+        :rtype: int
+        """
+        if (len(self) == 0):
+            return None
+
+        # first image after the timestamp
+        i = bisect.bisect_right(self.datetimes, timestamp.strftime(datetime_format))
+        if (i == len(self)):
+            return i - 1
+        if (i == 0):
+            return 0
+
+        previous_datetime = parse_datetime(self.datetimes[i - 1])
+        current_datetime = parse_datetime(self.datetimes[i])
+        if (timestamp - previous_datetime < current_datetime - timestamp):
+            return i - 1
+        return i
+
+
+def parse_datetime(string):
+    """
+    :param string: a datetime as written in the analyser files
+    :type string: str
+
+    :return: the parsed datetime
+    :rtype: datetime.datetime
+    """
+    return datetime.datetime.strptime(string, "%Y-%m-%d %H:%M:%S.%f")
+
+
+def get_index_path(path):
+    """
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the path of the index of the analyser file
+    :rtype: str
+    """
+    return join(dirname(path), index_directory, basename(path) + ".idx")
+
+
+def build_index(path, index=None):
+    """
+    Scan an analyser file once and collect the position of every image. Large files are scanned in parallel
+    (see analyser_chunks.parse_file)
+
+    :param path: the path of the analyser file
+    :param index: the index of the file before it grew. Only the data from its last image on is scanned
+    :type path: str
+    :type index: AnalyserIndex
+
+    :return: the index of the file
+    :rtype: AnalyserIndex
+    """
+    stat = os.stat(path)
+    if (index is None or len(index) == 0):
+        logging.debug("Building index of %s", path)
+        index = AnalyserIndex(path, stat.st_size, stat.st_mtime_ns)
+        parsed = parse_file(path, loci=False)
+    else:
+        logging.debug("Updating index of %s", path)
+        # the last image could have been incomplete
+        offset = index.offsets[-1]
+        index.truncate(len(index) - 1)
+        index.size = stat.st_size
+        index.mtime = stat.st_mtime_ns
+        parsed = parse_range(path, offset, get_data_size(path), loci=False)
+
+    for image in zip(parsed.ids, parsed.datetimes, parsed.offsets, parsed.rows, parsed.locus_counts):
+        index.append(image[0], from_microseconds(image[1]).strftime(datetime_format), image[2], image[3], image[4])
+
+    logging.debug("Indexed %d images of %s", len(index), path)
+    return index
+
+
+def save_index(index):
+    """
+    Save an index next to its analyser file
+
+    :param index: the index
+    :type index: AnalyserIndex
+    """
+    index_path = get_index_path(index.path)
+    os.makedirs(dirname(index_path), exist_ok=True)
+
+    temp_path = index_path + ".tmp"
+    with open(temp_path, 'w', newline='') as index_file:
+        csv_writer = csv.writer(index_file, delimiter=';')
+        csv_writer.writerow(['#', index.size, index.mtime])
+        csv_writer.writerows(zip(index.ids, index.datetimes, index.offsets, index.rows, index.locus_counts))
+    os.replace(temp_path, index_path)
+
+
+def load_index(path):
+    """
+    Load the saved index of an analyser file
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the index as it has been saved (it can be outdated, see get_index) or None if there is no index
+    :rtype: AnalyserIndex
+    """
+    index_path = get_index_path(path)
+    if (not os.path.isfile(index_path)):
+        return None
+
+    with open(index_path, 'r', newline='') as index_file:
+        csv_reader = csv.reader(index_file, delimiter=';')
+        header = next(csv_reader, None)
+        if (header is None):
+            return None
+
+        index = AnalyserIndex(path, int(header[1]), int(header[2]))
+        for row in csv_reader:
+            index.append(int(row[0]), row[1], int(row[2]), int(row[3]), int(row[4]))
+    return index
+
+
+def get_index(path):
+    """
+    Get the index of an analyser file. The index is loaded from disk or built and saved if necessary.
+    If the file only grew since the index has been built, only the new data is indexed
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the index of the file
+    :rtype: AnalyserIndex
+    """
+    stat = os.stat(path)
+    index = _indexes.get(path)
+    if (index is None):
+        index = load_index(path)
+    if (index is not None and index.size == stat.st_size and index.mtime == stat.st_mtime_ns):
+        metrics.count("analyser_index.cache_hits")
+        _indexes[path] = index
+        return index
+
+    with metrics.span("analyser_index.build"):
+        if (index is not None and index.size < stat.st_size):
+            index = build_index(path, index)
+        else:
+            index = build_index(path)
+        save_index(index)
+    _indexes[path] = index
+    return index
+
+
+def read_rows(path, offset, count):
+    """
+    Read rows of an analyser file starting at a byte offset
+
+    :param path: the path of the analyser file
+    :param offset: the byte offset of the first row
+    :param count: the amount of rows to read
+    :type path: str
+    :type offset: int
+    :type count: int
+
+    :return: the rows
+    :rtype: list[list[str]]
+    """
+    metrics.count("analyser.rows_read", count)
+    with open_data_file(path, 'r', newline='') as csv_file:
+        csv_file.seek(offset)
+        return list(csv.reader(islice(csv_file, count), delimiter=';'))
@@ -0,0 +1,232 @@
+"""
+Manifest of the analyser files of a directory
+
+The manifest records the first and last timestamp, the size and the modification time of every analyser file.
+It is saved in the hidden directory ".index" of the analyser directory and only the new or changed files are
+read again, so the files don't have to be renamed to find the file of a timestamp. The changes of the directory
+are tracked incrementally (see directory_tracker.py), so an update costs O(changes) instead of O(files).
+
+structure of a manifest file:
+file name;first timestamp;last timestamp;file size;file mtime in ns
+...
+"""
+import bisect
+import csv
+import datetime
+import logging
+import os
+
+from os.path import join
+
+import metrics
+
+from analyser_blocks import compressed_extension, open_data_file
+from analyser_index import datetime_format, index_directory, parse_datetime
+from directory_tracker import DirectoryTracker, FileState
+
+manifest_file_name = "manifest.csv"
+analyser_extensions = (".csv", ".csv" + compressed_extension)
+
+# the amount of bytes read from the end of a file to find its last timestamp
+tail_size = 65536
+
+# loaded manifests (location -> AnalyserManifest)
+_manifests = {}
+
+
+class ManifestEntry(object):
+    """
+    The time range of a single analyser file
+    """
+    __slots__ = ('name', 'first', 'last', 'size', 'mtime')
+
+    def __init__(self, name, first, last, size, mtime):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.size = size
+        self.mtime = mtime
+
+
+def read_time_range(path):
+    """
+    Read the timestamps of the first and the last row of an analyser file
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the first and last timestamp or None if the file contains no rows
+    :rtype: tuple[datetime.datetime, datetime.datetime]
+    """
+    with open_data_file(path, 'rb') as csv_file:
+        first_line = csv_file.readline()
+        if (not first_line.endswith(b'\n')):
+            return None
+
+        size = csv_file.seek(0, os.SEEK_END)
+        csv_file.seek(max(0, size - tail_size))
+        # the last line could be incomplete
+        tail_lines = csv_file.read().split(b'\n')[:-1]
+
+    fields = first_line.split(b';', 2)
+    if (len(fields) < 3):
+        return None
+    first = parse_datetime(fields[1].decode())
+    last = first
+    for line in reversed(tail_lines):
+        fields = line.split(b';', 2)
+        if (len(fields) == 3):
+            last = parse_datetime(fields[1].decode())
+            break
+    return first, last
+
+
+class AnalyserManifest(object):
+    """
+    The analyser files of a directory sorted by their first timestamp
+    """
+    __slots__ = ('location', 'entries', 'firsts', 'tracker')
+
+    def __init__(self, location):
+        self.location = location
+        self.entries = []
+        self.firsts = []
+        self.tracker = DirectoryTracker(location, lambda name: name.endswith(analyser_extensions))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self):
+        """
+        Read the time range of the new and changed files and remove the deleted files
+
+        :return: True if the manifest changed
+        :rtype: bool
+        """
+        with metrics.span("manifest.update"):
+            if (len(self.tracker) == 0 and len(self.entries) > 0):
+                # the entries of a loaded manifest, which are verified by the first poll
+                self.tracker.restore(dict((entry.name, FileState(entry.size, entry.mtime)) for entry in self.entries))
+            changes = self.tracker.poll()
+            if (not changes):
+                metrics.count("manifest.cache_hits")
+                return False
+
+            entries = dict((entry.name, entry) for entry in self.entries)
+            for name in changes.removed:
+                entries.pop(name, None)
+            for name in changes.added + changes.grown:
+                # files which were empty before are reported as grown
+                state = self.tracker.files.get(name)
+                if (state is None):
+                    continue
+                path = join(self.location, name)
+                metrics.count("manifest.files_read")
+                try:
+                    time_range = read_time_range(path)
+                except ValueError as e:
+                    # e.g. a file compressed without blocks (see analyser_blocks.py)
+                    logging.error("Skipping \"%s\": %s", path, e)
+                    entries.pop(name, None)
+                    continue
+                if (time_range is None):
+                    logging.debug("File \"%s\" is empty", path)
+                    entries.pop(name, None)
+                    continue
+                entries[name] = ManifestEntry(name, time_range[0], time_range[1], state.size, state.mtime)
+
+        self.entries = sorted(entries.values(), key=lambda e: (e.first, e.name))
+        self.firsts = [entry.first for entry in self.entries]
+        return True
+
+    def find(self, timestamp):
+        """
+        :param timestamp: the timestamp
+        :type timestamp: datetime.datetime
+
+        :return: the position of the last file starting before the timestamp or None if there is none
+        :rtype: int
+        """
+        i = bisect.bisect_left(self.firsts, timestamp) - 1
+        if (i < 0):
+            return None
+        return i
+
+    def get_path(self, i):
+        """
+        :param i: the position of the file in the manifest
+        :type i: int
+
+        :return: the path of the file
+        :rtype: str
+        """
+        return join(self.location, self.entries[i].name)
+
+
+def get_manifest_path(location):
+    """
+    :param location: the analyser directory
+    :type location: str
+
+    :return: the path of the manifest of the directory
+    :rtype: str
+    """
+    return join(location, index_directory, manifest_file_name)
+
+
+def save_manifest(manifest):
+    """
+    :param manifest: the manifest to save in its directory
+    :type manifest: AnalyserManifest
+    """
+    manifest_path = get_manifest_path(manifest.location)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', newline='') as manifest_file:
+        csv_writer = csv.writer(manifest_file, delimiter=';')
+        for entry in manifest.entries:
+            csv_writer.writerow([entry.name, entry.first.strftime(datetime_format),
+                                 entry.last.strftime(datetime_format), entry.size, entry.mtime])
+    os.replace(temp_path, manifest_path)
+
+
+def load_manifest(location):
+    """
+    :param location: the analyser directory
+    :type location: str
+
+    :return: the manifest as it has been saved (it can be outdated) or an empty manifest if there is none
+    :rtype: AnalyserManifest
+    """
+    manifest = AnalyserManifest(location)
+    manifest_path = get_manifest_path(location)
+    if (not os.path.isfile(manifest_path)):
+        return manifest
+
+    with open(manifest_path, 'r', newline='') as manifest_file:
+        for row in csv.reader(manifest_file, delimiter=';'):
+            manifest.entries.append(ManifestEntry(row[0], datetime.datetime.strptime(row[1], datetime_format),
+                                                  datetime.datetime.strptime(row[2], datetime_format),
+                                                  int(row[3]), int(row[4])))
+    manifest.firsts = [entry.first for entry in manifest.entries]
+    return manifest
+
+
+def get_manifest(location):
+    """
+    Get the up to date manifest of an analyser directory
+
+    :param location: the analyser directory
+    :type location: str
+
+    :return: the manifest
+    :rtype: AnalyserManifest
+    """
+    manifest = _manifests.get(location)
+    if (manifest is None):
+        manifest = load_manifest(location)
+        _manifests[location] = manifest
+    if (manifest.update()):
+        save_manifest(manifest)
+    return manifest
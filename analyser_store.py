@@ -0,0 +1,267 @@
+"""
+Binary columnar store of analyser csv files
+
+An analyser file is converted once into a binary file in the hidden directory ".index" next to it.
+The store is memory mapped, so reading an image is a slice of the columns instead of parsing text.
+
+structure of a store file (native byte order, every section aligned to 8 bytes):
+header: magic, csv file size, csv file mtime in ns, image count (n), locus count (m)
+image columns: id (int64[n]), datetime in microseconds since epoch (int64[n]),
+               locus count (int64[n]), first locus (int64[n + 1])
+locus columns: number, classification, color_r, color_g, color_b, height (int32[m] each),
+               spectra (float32[m * spectra_count])
+recipes: the recipe of every image separated by newlines (utf-8)
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from array import array
+from os.path import basename, dirname, isfile, join
+
+import metrics
+
+from analyser_chunks import parse_file, spectra_count
+from analyser_image import AnalyserImage, locus_columns
+from analyser_index import index_directory
+from analyser_manifest import analyser_extensions
+from timings import from_microseconds, to_microseconds
+
+magic = b'ASTORE01'
+header_format = '=8sqqqq'
+
+# opened stores (path -> AnalyserStore)
+_stores = {}
+# held while a store is replaced or read, so a store isn't closed while it is read
+store_lock = threading.RLock()
+
+
+def get_store_path(path):
+    """
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the path of the binary store of the analyser file
+    :rtype: str
+    """
+    return join(dirname(path), index_directory, basename(path) + ".bin")
+
+
+def _padding(length):
+    return b'\0' * (-length % 8)
+
+
+def convert_analyser_file(path):
+    """
+    Convert an analyser csv file into a binary columnar store. Large files are parsed in parallel
+    (see analyser_chunks.parse_file)
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the path of the store
+    :rtype: str
+    """
+    logging.debug("Converting %s into a binary store", path)
+    stat = os.stat(path)
+
+    parsed = parse_file(path)
+    ids = parsed.ids
+    starts = array('q', [0])
+    for rows in parsed.rows:
+        starts.append(starts[-1] + rows)
+
+    store_path = get_store_path(path)
+    os.makedirs(dirname(store_path), exist_ok=True)
+    temp_path = store_path + ".tmp"
+    with open(temp_path, 'wb') as store_file:
+        store_file.write(struct.pack(header_format, magic, stat.st_size, stat.st_mtime_ns,
+                                     len(ids), starts[-1]))
+        for column in [ids, parsed.datetimes, parsed.locus_counts, starts] + parsed.columns + [parsed.spectra]:
+            data = column.tobytes()
+            store_file.write(data)
+            store_file.write(_padding(len(data)))
+        store_file.write('\n'.join(parsed.recipes).encode())
+    os.replace(temp_path, store_path)
+
+    logging.debug("Converted %d images with %d loci of %s", len(ids), starts[-1], path)
+    return store_path
+
+
+def convert_directory(location):
+    """
+    Convert all analyser csv files of a directory, which have no up to date store yet
+
+    :param location: the directory of the analyser files
+    :type location: str
+    """
+    for file in sorted(os.listdir(location)):
+        path = join(location, file)
+        if (isfile(path) and file.endswith(analyser_extensions) and load_store(path) is None):
+            convert_analyser_file(path)
+
+
+class AnalyserStore(object):
+    """
+    A memory mapped binary store of a single analyser file
+    """
+    __slots__ = ('path', 'size', 'mtime', 'ids', 'datetimes', 'locus_counts', 'starts', 'columns', 'spectra',
+                 'recipes', '_mmap')
+
+    def __init__(self, path, store_file):
+        self.path = path
+        self._mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+
+        _, self.size, self.mtime, image_count, locus_count = struct.unpack_from(header_format, self._mmap)
+        position = struct.calcsize(header_format)
+
+        def column(type_code, length):
+            nonlocal position
+            item_size = array(type_code).itemsize
+            data = view[position:position + item_size * length].cast(type_code)
+            position += item_size * length
+            position += -position % 8
+            return data
+
+        self.ids = column('q', image_count)
+        self.datetimes = column('q', image_count)
+        self.locus_counts = column('q', image_count)
+        self.starts = column('q', image_count + 1)
+        self.columns = dict((name, column('i', locus_count)) for name in locus_columns)
+        self.spectra = column('f', locus_count * spectra_count)
+        self.recipes = bytes(view[position:]).decode().split('\n')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        """
+        Release the columns and unmap the store, so it can be replaced (a mapped file can't be replaced on
+        windows). The store can't be read afterwards
+        """
+        for data in [self.ids, self.datetimes, self.locus_counts, self.starts, self.spectra]:
+            data.release()
+        for data in self.columns.values():
+            data.release()
+        self._mmap.close()
+
+    def is_complete(self, i):
+        """
+        :param i: the position of the image in the store
+        :type i: int
+
+        :return: True if all loci of the image are in this file
+        :rtype: bool
+        """
+        return self.starts[i + 1] - self.starts[i] == self.locus_counts[i]
+
+    def find_closest(self, timestamp):
+        """
+        Binary search the image closest to a timestamp
+
+        :param timestamp: the timestamp to search for
+        :type timestamp: datetime.datetime
+
+        :return: the position of the closest image in the store or None if the store is empty
+        :rtype: int
+        """
+        if (len(self) == 0):
+            return None
+
+        target = to_microseconds(timestamp)
+        i = bisect.bisect_right(self.datetimes, target)
+        if (i == len(self)):
+            return i - 1
+        if (i != 0 and target - self.datetimes[i - 1] < self.datetimes[i] - target):
+            return i - 1
+        return i
+
+    def get_image(self, i):
+        """
+        :param i: the position of the image in the store
+        :type i: int
+
+        :return: the image with its loci in this file. The columns are copied from the store
+        :rtype: AnalyserImage
+        """
+        image = AnalyserImage(self.ids[i], from_microseconds(self.datetimes[i]), self.locus_counts[i], self.recipes[i])
+        start = self.starts[i]
+        end = self.starts[i + 1]
+        for column, name in zip(image.columns, locus_columns):
+            column.frombytes(self.columns[name][start:end].cast('B'))
+        image.spectra.frombytes(self.spectra[start * spectra_count:end * spectra_count].cast('B'))
+        return image
+
+
+def load_store(path):
+    """
+    Open the binary store of an analyser file
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the store or None if there is no store or it is outdated
+    :rtype: AnalyserStore
+    """
+    store_path = get_store_path(path)
+    if (not isfile(store_path)):
+        return None
+
+    stat = os.stat(path)
+    with open(store_path, 'rb') as store_file:
+        header = store_file.read(struct.calcsize(header_format))
+        if (len(header) != struct.calcsize(header_format)):
+            return None
+        store_magic, size, mtime, _, _ = struct.unpack(header_format, header)
+        if (store_magic != magic or size != stat.st_size or mtime != stat.st_mtime_ns):
+            logging.debug("Store of %s is outdated", path)
+            return None
+        return AnalyserStore(path, store_file)
+
+
+def get_store(path):
+    """
+    Get the binary store of an analyser file. The file is converted if necessary
+
+    :param path: the path of the analyser file
+    :type path: str
+
+    :return: the store of the file or None if the file kept changing while it was converted
+    :rtype: AnalyserStore
+    """
+    stat = os.stat(path)
+    with store_lock:
+        store = _stores.get(path)
+        if (store is not None and store.size == stat.st_size and store.mtime == stat.st_mtime_ns):
+            metrics.count("analyser_store.cache_hits")
+            return store
+
+        if (store is not None):
+            # the file changed, the old store is replaced
+            store.close()
+            del _stores[path]
+
+        store = load_store(path)
+        # a file written during the conversion outdates the new store, it is converted once more
+        for _ in range(2):
+            if (store is not None):
+                break
+            with metrics.span("analyser_store.convert"):
+                convert_analyser_file(path)
+            store = load_store(path)
+        if (store is None):
+            logging.warning("%s changed while it was converted", path)
+            return None
+        _stores[path] = store
+        return store
+
+
+if (__name__ == "__main__"):
+    logging.basicConfig(level=logging.DEBUG)
+    for directory in sys.argv[1:]:
+        convert_directory(directory)
@@ -0,0 +1,425 @@
+"""
+Benchmark of the synchronizer with synthetic data
+
+Generates analyser csv files, kinect frames and a sqlite database standing in for mysql
+(opc_data with the line speeds and the Bandwaage, data_analyser_x101_daten) with its tables exported as csv
+files for every data size, times every stage of the synchronization with the sqlite and the local backend
+and saves the results as json.
+
+usage:
+python benchmark.py [size ...]  # run the benchmark for the data sizes (default benchmark_sizes)
+python benchmark.py compare <old result> <new result>  # compare the results of two runs
+
+structure of a result file:
+{
+    'started': start of the run,
+    'python': python version,
+    'results': [
+        {'size': data size, 'stage': stage name, 'seconds': [duration of every repetition]}, ...
+    ]
+}
+"""
+import csv
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+
+from os.path import join
+
+import synchsensordata
+
+from database import ConnectionPool, LocalBackend, SqliteBackend, to_sqlite_value
+from image_cache import get_image_cache
+from timings import get_time_offset_multiple_lines, get_time_offset_multiple_lines_profiles
+
+# =================
+# = Configuration =
+# =================
+
+benchmark_root = "benchmark_data"  # the directory the synthetic data is generated in
+benchmark_sizes = [1, 2, 4]  # every size generates size * seconds_per_size seconds of data
+seconds_per_size = 300
+repetitions = 5
+result_path = "log/benchmark_%Y-%m-%d_%H-%M-%S.json"
+seed = 1
+
+start_time = datetime.datetime(2018, 5, 24, 13, 53, 0)
+speed_interval = 0.2  # seconds between two speeds of a line
+analyser_interval = 0.1  # seconds between two analyser images
+kinect_interval = 0.1  # seconds between two kinect frames
+analyser_rows_per_file = 2000  # the files are split like split_file.py does, so images are split between files
+
+bandwaage_item = "ET 200SP-Station_1.ET200SP.OPC_DATA.Messwerte.BANDWAAGE"
+
+# the progress of the benchmark, the synchronizer itself only logs warnings
+logger = logging.getLogger("benchmark")
+
+
+# ==============
+# = Generators =
+# ==============
+
+def generate_analyser_files(location, start, end, rng):
+    """
+    Generate analyser csv files in the 267 column format
+
+    :param location: the directory of the files
+    :param start: the time of the first image
+    :param end: the time after the last image
+    :param rng: the random number generator
+    :type location: str
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :type rng: random.Random
+
+    :return: the amount of images
+    :rtype: int
+    """
+    os.makedirs(location)
+    csv_file = None
+    rows_in_file = 0
+    image_id = 0
+    timestamp = start
+    while (timestamp < end):
+        image_id += 1
+        locus_count = rng.randint(1, 8)
+        for number in range(locus_count):
+            if (csv_file is None or rows_in_file >= analyser_rows_per_file):
+                if (csv_file is not None):
+                    csv_file.close()
+                csv_file = open(join(location, timestamp.strftime("kipro-analyser-data_%Y-%m-%d_%H-%M-%S.%f.csv")),
+                                'w', newline='')
+                rows_in_file = 0
+
+            row = [str(image_id), timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3], str(number), str(locus_count),
+                   "0"]
+            row += ["%.6f" % rng.random() for _ in range(235)]
+            row += ["0"] * 21
+            row += [str(rng.randint(0, 5)), str(rng.randint(0, 255)), str(rng.randint(0, 255)),
+                    str(rng.randint(0, 255)), str(rng.randint(0, 100)), "recipe"]
+            csv_file.write(";".join(row) + "\n")
+            rows_in_file += 1
+        timestamp += datetime.timedelta(seconds=analyser_interval * rng.uniform(0.5, 1.5))
+    if (csv_file is not None):
+        csv_file.close()
+    return image_id
+
+
+def generate_kinect_files(location, prefixes, start, end, rng):
+    """
+    Generate kinect frames with their time of capture as modification time
+
+    :param location: the directory of the frames
+    :param prefixes: the file prefixes of the frames
+    :param start: the time of the first frame
+    :param end: the time after the last frame
+    :param rng: the random number generator
+    :type location: str
+    :type prefixes: list[str]
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :type rng: random.Random
+
+    :return: the amount of frames per prefix
+    :rtype: int
+    """
+    os.makedirs(location)
+    frame = 0
+    timestamp = start
+    while (timestamp < end):
+        for prefix in prefixes:
+            path = join(location, "%s_%06d.png" % (prefix, frame))
+            with open(path, 'wb') as frame_file:
+                frame_file.write(b'\0' * 64)
+            mtime = (timestamp + datetime.timedelta(milliseconds=rng.randint(0, 10))).timestamp()
+            os.utime(path, (mtime, mtime))
+        frame += 1
+        timestamp += datetime.timedelta(seconds=kinect_interval)
+    return frame
+
+
+def generate_database(path, export_location, start, end, rng):
+    """
+    Generate the speeds of the lines, the Bandwaage and the x101 analyser data in a sqlite database
+    and export the tables as csv files
+
+    :param path: the path of the database
+    :param export_location: the directory of the exported tables
+    :param start: the time of the first row
+    :param end: the time after the last row
+    :param rng: the random number generator
+    :type path: str
+    :type export_location: str
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :type rng: random.Random
+
+    :return: the amount of speeds per line
+    :rtype: int
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE opc_data (ITEM_NAME TEXT, ITEM_VALUE REAL, READ_TIME TEXT)")
+    connection.execute("CREATE INDEX opc_data_item_time ON opc_data (ITEM_NAME, READ_TIME)")
+    connection.execute("CREATE TABLE data_analyser_x101_daten (id INTEGER, time TEXT, %s)" % ", ".join(
+        "f%d REAL" % field_no for field_no in range(2, 20)))
+    connection.execute("CREATE INDEX data_analyser_x101_daten_time ON data_analyser_x101_daten (time)")
+
+    item_names = [synchsensordata.lines["selector_template"] % {'line_name': line["database_name"],
+                                                                'value_name': 'Istwert_Drehzahl'}
+                  for line in synchsensordata.lines["lines"]]
+    speeds = []
+    analyser_rows = []
+    timestamp = start
+    count = 0
+    while (timestamp < end):
+        for item_name in item_names:
+            speeds.append((item_name, rng.choice([1900, 2500, 3800, 3800]),
+                           timestamp + datetime.timedelta(milliseconds=rng.randint(0, 50))))
+        speeds.append((bandwaage_item, rng.uniform(0, 10), timestamp))
+        analyser_rows.append([count, timestamp] + [rng.random() for _ in range(2, 20)])
+        count += 1
+        timestamp += datetime.timedelta(seconds=speed_interval)
+
+    tables = {'opc_data': speeds, 'data_analyser_x101_daten': analyser_rows}
+    os.makedirs(export_location)
+    for table, rows in tables.items():
+        rows = [[to_sqlite_value(value) for value in row] for row in rows]
+        connection.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join(["?"] * len(rows[0]))), rows)
+        cursor = connection.execute("SELECT * FROM %s" % table)
+        with open(join(export_location, table + ".csv"), 'w', newline='') as table_file:
+            csv_writer = csv.writer(table_file)
+            csv_writer.writerow([column[0] for column in cursor.description])
+            csv_writer.writerows(cursor)
+    connection.commit()
+    connection.close()
+    return count
+
+
+def generate_data(location, size):
+    """
+    Generate all data of a benchmark size
+
+    :param location: the directory of the data
+    :param size: the data size
+    :type location: str
+    :type size: int
+    """
+    rng = random.Random(seed + size)
+    end = start_time + datetime.timedelta(seconds=size * seconds_per_size)
+    shutil.rmtree(location, ignore_errors=True)
+    os.makedirs(location)
+    logger.info("Generating data of size %d in %s", size, location)
+
+    speeds = generate_database(join(location, "kipro.sqlite"), join(location, "export"), start_time, end, rng)
+    images = generate_analyser_files(join(location, "udp_x102"), start_time + datetime.timedelta(seconds=13), end,
+                                     rng)
+    frames = generate_kinect_files(join(location, "kinect"), synchsensordata.kinect["file_prefixes"], start_time,
+                                   end, rng)
+    logger.info("Generated %d speeds per line, %d analyser images and %d kinect frames", speeds, images, frames)
+
+
+# =============
+# = Benchmark =
+# =============
+
+def configure(location):
+    """
+    Point the sensors of the synchronizer to the data of a benchmark size
+
+    :param location: the directory of the data
+    :type location: str
+    """
+    synchsensordata.kinect["location"] = join(location, "kinect")
+    synchsensordata.analyser["location"] = join(location, "udp_x102")
+
+
+def measure(stage, function, size, results, cached=False):
+    """
+    Time the repetitions of a stage
+
+    :param stage: the name of the stage
+    :param function: the stage
+    :param size: the data size
+    :param results: the results the durations are added to
+    :param cached: keep the parsed analyser images cached between the stages and repetitions
+        (see image_cache.py), otherwise the cache is cleared before every repetition
+    :type stage: str
+    :type function: function
+    :type size: int
+    :type results: list[dict]
+    :type cached: bool
+    """
+    seconds = []
+    for _ in range(repetitions):
+        if (not cached):
+            get_image_cache().clear()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    results.append({'size': size, 'stage': stage, 'seconds': seconds})
+    logger.info("%-45s size %d: first %.6f s, best %.6f s", stage, size, seconds[0], min(seconds))
+
+
+def benchmark_database(backend, connect, size, moments, results):
+    """
+    Time the stages depending on the database with a backend
+
+    :param backend: the name of the backend
+    :param connect: opens the backend
+    :param size: the data size
+    :param moments: the moments the material was at current_position
+    :param results: the results the durations are added to
+    :type backend: str
+    :type connect: () -> Backend
+    :type size: int
+    :type moments: list[datetime.datetime]
+    :type results: list[dict]
+
+    :return: the speeds of the lines (see synchsensordata.get_speeds) and their profiles
+    :rtype: tuple[list[list[dict]], list[SpeedProfile]]
+    """
+    def connect_and_query():
+        connected = connect()
+        connected.get_sensor_rows(synchsensordata.bandwaage, moments[0], moments[0])
+        connected.close()
+    measure("%s connect and first query" % backend, connect_and_query, size, results)
+
+    db = connect()
+    measure("%s get_speeds" % backend, lambda: synchsensordata.get_speeds(db), size, results)
+
+    def fetch_histories():
+        histories = synchsensordata.create_speed_histories()
+        histories.fetch(db, synchsensordata.fetch_limit)
+        return histories
+    measure("%s SpeedHistories.fetch" % backend, fetch_histories, size, results)
+
+    for sensor in synchsensordata.sensors:
+        if (sensor['data'] == 'database'):
+            measure("%s get_sensor_data[%s %s]" % (backend, sensor['data'], sensor['name']),
+                    lambda: [synchsensordata.get_sensor_data(moment, sensor, db) for moment in moments[:10]],
+                    size, results)
+
+    measure("%s synchronize_batch" % backend, lambda: synchsensordata.synchronize_batch(db, moments=moments), size,
+            results)
+    pool = ConnectionPool(connect, synchsensordata.connection_pool_size)
+    measure("%s synchronize_batch concurrent" % backend,
+            lambda: synchsensordata.synchronize_batch(db, moments=moments, pool=pool), size, results)
+    pool.close()
+
+    speeds = synchsensordata.get_speeds(db)
+    profiles = fetch_histories().profiles
+    db.close()
+    return speeds, profiles
+
+
+def benchmark_size(size, results):
+    """
+    Generate the data of a size and time all stages on it
+
+    :param size: the data size
+    :param results: the results the durations are added to
+    :type size: int
+    :type results: list[dict]
+    """
+    location = join(benchmark_root, "size_%d" % size)
+    generate_data(location, size)
+    configure(location)
+
+    rng = random.Random(seed)
+    duration = size * seconds_per_size
+    moments = sorted(start_time + datetime.timedelta(seconds=rng.uniform(30, duration - 5)) for _ in range(100))
+    lengths = [line["length"] for line in synchsensordata.lines["lines"]]
+
+    v_all, profiles = benchmark_database("sqlite", lambda: SqliteBackend(join(location, "kipro.sqlite")), size,
+                                         moments, results)
+    benchmark_database("local", lambda: LocalBackend(join(location, "export")), size, moments, results)
+
+    measure("get_time_offset_multiple_lines",
+            lambda: [get_time_offset_multiple_lines(sensor['position'], synchsensordata.current_position, lengths,
+                                                    v_all)
+                     for sensor in synchsensordata.sensors], size, results)
+    measure("get_time_offset_multiple_lines_profiles",
+            lambda: [get_time_offset_multiple_lines_profiles(sensor['position'], synchsensordata.current_position,
+                                                             lengths, profiles)
+                     for sensor in synchsensordata.sensors], size, results)
+
+    for sensor in synchsensordata.sensors:
+        if (sensor['data'] != 'file'):
+            continue
+        stage = "get_sensor_data[%s %s]" % (sensor['data'], sensor['specification'])
+        if (sensor['specification'] == 'csv'):
+            for lookup in ('scan', 'fast_scan', 'index', 'store'):
+                synchsensordata.analyser_lookup = lookup
+                measure("%s %s" % (stage, lookup),
+                        lambda: [synchsensordata.get_sensor_data(moment, sensor) for moment in moments[:10]],
+                        size, results)
+            synchsensordata.analyser_lookup = "index"
+            # the images are parsed by the first repetition and read from the cache by the others
+            get_image_cache().clear()
+            measure("%s index cached" % stage,
+                    lambda: [synchsensordata.get_sensor_data(moment, sensor) for moment in moments[:10]],
+                    size, results, cached=True)
+        else:
+            measure(stage, lambda: [synchsensordata.get_sensor_data(moment, sensor) for moment in moments[:10]],
+                    size, results)
+
+
+def run(sizes):
+    """
+    Run the benchmark and save the results
+
+    :param sizes: the data sizes
+    :type sizes: list[int]
+
+    :return: the path of the result file
+    :rtype: str
+    """
+    started = datetime.datetime.now()
+    results = []
+    for size in sizes:
+        benchmark_size(size, results)
+
+    path = started.strftime(result_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as result_file:
+        json.dump({'started': str(started), 'python': sys.version, 'results': results}, result_file, indent=2)
+    logger.info("Saved the results in %s", path)
+    return path
+
+
+def compare(old_path, new_path):
+    """
+    Print the best durations of two runs side by side
+
+    :param old_path: the result file of the old run
+    :param new_path: the result file of the new run
+    :type old_path: str
+    :type new_path: str
+    """
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old = dict(((r['size'], r['stage']), min(r['seconds'])) for r in json.load(old_file)['results'])
+        new = dict(((r['size'], r['stage']), min(r['seconds'])) for r in json.load(new_file)['results'])
+
+    print("%-55s %12s %12s %8s" % ("stage", "old [s]", "new [s]", "ratio"))
+    for key in sorted(set(old) | set(new)):
+        name = "%s (size %d)" % (key[1], key[0])
+        if (key in old and key in new):
+            print("%-55s %12.6f %12.6f %8.2f" % (name, old[key], new[key], new[key] / old[key] if old[key] else 0))
+        else:
+            print("%-55s %12s %12s" % (name, "%.6f" % old[key] if key in old else "-",
+                                       "%.6f" % new[key] if key in new else "-"))
+
+
+if (__name__ == "__main__"):
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s] [%(levelname)s] %(message)s')
+    logger.setLevel(logging.INFO)
+    if (len(sys.argv) == 4 and sys.argv[1] == "compare"):
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        run([int(size) for size in sys.argv[1:]] or benchmark_sizes)
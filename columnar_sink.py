@@ -0,0 +1,296 @@
+"""
+Columnar shards of synchronized records
+
+The records are buffered column by column and written in batches into shard files of a directory
+(records_000001.shard, records_000002.shard, ...), so only one batch is held in memory. Every shard
+can be memory mapped (e.g. numpy.memmap with the offset, type and shape of a column from the header
+or load_shard) without parsing.
+
+columns of a shard with n records (sensor names from the sensor configuration):
+time: the moment of the record in microseconds since epoch (int64[n])
+<image sensor>.<file prefix>: the path of the frame of every file prefix (str[n])
+<csv sensor>.id, .datetime (microseconds since epoch), .locus_count: the analyser image (int64[n], -1 if missing)
+<csv sensor>.recipe: the recipe of the image (str[n])
+<csv sensor>.loci: the first locus of every image in the locus columns (int64[n + 1])
+<csv sensor>.number, .classification, .color_r, .color_g, .color_b, .height: the loci (int32[m] each)
+<csv sensor>.spectra: the spectra of the loci (float32[m, spectra_count])
+<database sensor>.<field name>: the fields of a sensor with multiple fields (float64[n], nan if missing)
+<database sensor>: the value of a sensor with a single field (float64[n], nan if missing)
+
+structure of a shard file (native byte order, every column aligned to 8 bytes):
+magic, header length (int64), header (json, see get_header), columns
+str columns are stored as utf-8 data (uint8) and the column <name>.offsets with the start of every string (int64[n + 1])
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+
+from array import array
+from os.path import join
+
+from analyser_chunks import spectra_count
+from analyser_image import locus_columns
+from timings import to_microseconds
+
+magic = b'RSHARD01'
+shard_pattern = "records_%06d.shard"
+
+# records buffered before a shard is written
+batch_size = 256
+# bytes buffered before a shard is written (the spectra of large images fill a batch earlier)
+max_batch_bytes = 64 * 1024 * 1024
+
+
+def to_float(value):
+    """
+    :param value: a value of a database sensor
+    :return: the value as float or nan if it is missing or not numeric
+    :rtype: float
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class ColumnarSink(object):
+    """
+    Appends every record to the columns of the current batch and writes full batches as shards
+    """
+
+    def __init__(self, directory, sensors):
+        """
+        :param directory: the directory of the shards. Existing shards are kept and numbered after
+        :param sensors: the sensor configuration the records are synchronized with
+        :type directory: str
+        :type sensors: list[dict]
+        """
+        self.directory = directory
+        self.sensors = sensors
+        os.makedirs(directory, exist_ok=True)
+        numbers = [int(m.group(1)) for m in map(re.compile(r"records_(\d+)\.shard$").match, os.listdir(directory))
+                   if m is not None]
+        self.shard_no = max(numbers, default=0)
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.columns = {}
+        self.strings = {}
+
+    def _column(self, name, type_code, fill=None):
+        """
+        :return: the buffered column, new columns are filled with the fill value for the previous records
+        :rtype: array
+        """
+        column = self.columns.get(name)
+        if (column is None):
+            column = array(type_code, [fill] * self.count if (fill is not None) else [])
+            self.columns[name] = column
+        return column
+
+    def _add_string(self, name, value):
+        self.strings.setdefault(name, []).append(value or "")
+
+    def _add_image(self, name, image):
+        loci = self._column(name + ".loci", 'q')
+        if (len(loci) == 0):
+            loci.append(0)
+        for column_name in locus_columns:
+            self._column(name + "." + column_name, 'i')
+        self._column(name + ".spectra", 'f')
+
+        if (image is None):
+            for column_name in ('id', 'datetime', 'locus_count'):
+                self._column(name + "." + column_name, 'q').append(-1)
+            self._add_string(name + ".recipe", None)
+            loci.append(loci[-1])
+            return
+
+        self._column(name + ".id", 'q').append(image.id)
+        self._column(name + ".datetime", 'q').append(to_microseconds(image.datetime))
+        self._column(name + ".locus_count", 'q').append(image.locus_count)
+        self._add_string(name + ".recipe", image.recipe)
+        for column_name, values in zip(locus_columns, image.columns):
+            self.columns[name + "." + column_name].extend(values)
+        self.columns[name + ".spectra"].extend(image.spectra)
+        loci.append(loci[-1] + len(image.columns[0]))
+
+    def write(self, record):
+        """
+        :param record: the moment of the record and the data of every sensor
+        :type record: dict
+        """
+        self._column("time", 'q').append(to_microseconds(record['time']))
+        for sensor in self.sensors:
+            name = sensor['name']
+            data = record['sensors'].get(name)
+            if (sensor['data'] == 'file' and sensor['specification'] == 'image'):
+                if (data is None or isinstance(data, str)):
+                    data = [data] * len(sensor['file_prefixes']) if (data is None) else [data]
+                for prefix, frame in zip(sensor['file_prefixes'], data):
+                    # the names of the frames or the loaded frames (see kinect_frames.py)
+                    self._add_string(name + "." + prefix, frame and join(sensor['location'], str(frame)))
+            elif (sensor['data'] == 'file'):
+                self._add_image(name, data)
+            elif ('field_no' in sensor['location']):
+                fields = data or {}
+                for field_name, value in fields.items():
+                    self._column(name + "." + field_name, 'd', math.nan).append(to_float(value))
+                # fields missing in this record
+                for column_name, column in self.columns.items():
+                    if (column_name.startswith(name + ".") and len(column) == self.count):
+                        column.append(math.nan)
+            else:
+                self._column(name, 'd').append(to_float(data))
+        self.count += 1
+
+        if (self.count >= batch_size or self.get_batch_size() >= max_batch_bytes):
+            self.flush()
+
+    def get_batch_size(self):
+        """
+        :return: the approximate amount of bytes buffered
+        :rtype: int
+        """
+        return (sum(len(column) * column.itemsize for column in self.columns.values()) +
+                sum(sum(map(len, strings)) for strings in self.strings.values()))
+
+    def get_header(self):
+        """
+        :return: the columns of the batch in the order they are written. Every column is described by
+            its name, type code (array type code or 'str'), shape and byte offset (set by flush)
+        :rtype: list[dict]
+        """
+        header = []
+        for name, column in self.columns.items():
+            shape = [len(column)]
+            if (name.endswith(".spectra")):
+                shape = [len(column) // spectra_count, spectra_count]
+            header.append({'name': name, 'type': column.typecode, 'shape': shape})
+        for name in self.strings:
+            header.append({'name': name + ".offsets", 'type': 'q', 'shape': [self.count + 1]})
+            header.append({'name': name, 'type': 'str', 'shape': [None]})
+        return header
+
+    def flush(self):
+        """
+        Write the buffered records as a new shard
+        """
+        if (self.count == 0):
+            return
+
+        data = {}
+        for name, column in self.columns.items():
+            data[name] = column.tobytes()
+        for name, strings in self.strings.items():
+            encoded = [string.encode() for string in strings]
+            offsets = array('q', [0])
+            for string in encoded:
+                offsets.append(offsets[-1] + len(string))
+            data[name + ".offsets"] = offsets.tobytes()
+            data[name] = b''.join(encoded)
+
+        header = self.get_header()
+        # the offsets depend on the length of the header, which depends on the offsets
+        header_length = 0
+        while True:
+            position = len(magic) + 8 + header_length
+            position += -position % 8
+            for column in header:
+                column['offset'] = position
+                if (column['type'] == 'str'):
+                    column['shape'] = [len(data[column['name']])]
+                position += len(data[column['name']])
+                position += -position % 8
+            header_bytes = json.dumps({'count': self.count, 'columns': header}).encode()
+            if (len(header_bytes) == header_length):
+                break
+            header_length = len(header_bytes)
+
+        self.shard_no += 1
+        path = join(self.directory, shard_pattern % self.shard_no)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as shard_file:
+            shard_file.write(magic + struct.pack('=q', header_length) + header_bytes)
+            for column in header:
+                shard_file.write(b'\0' * (column['offset'] - shard_file.tell()))
+                shard_file.write(data[column['name']])
+        os.replace(temp_path, path)
+        logging.debug("Wrote %d records to %s", self.count, path)
+        self._reset()
+
+    def close(self):
+        self.flush()
+
+
+class Shard(object):
+    """
+    A memory mapped shard
+    """
+    __slots__ = ('path', 'count', 'columns', '_mmap')
+
+    def __init__(self, path, shard_file):
+        self.path = path
+        self._mmap = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if (self._mmap[:len(magic)] != magic):
+            raise ValueError("%s is no shard" % path)
+        header_length = struct.unpack_from('=q', self._mmap, len(magic))[0]
+        header = json.loads(self._mmap[len(magic) + 8:len(magic) + 8 + header_length].decode())
+
+        self.count = header['count']
+        self.columns = {}
+        view = memoryview(self._mmap)
+        for column in header['columns']:
+            type_code = 'B' if (column['type'] == 'str') else column['type']
+            size = array(type_code).itemsize * math.prod(column['shape'])
+            if (size == 0):
+                # memoryviews of empty columns can't be cast
+                self.columns[column['name']] = array(type_code)
+            else:
+                self.columns[column['name']] = view[column['offset']:column['offset'] + size].cast(type_code,
+                                                                                                  column['shape'])
+
+    def __len__(self):
+        return self.count
+
+    def get_string(self, name, i):
+        """
+        :param name: the name of a str column
+        :param i: the position of the record
+        :type name: str
+        :type i: int
+
+        :return: the string of the record
+        :rtype: str
+        """
+        offsets = self.columns[name + ".offsets"]
+        return bytes(self.columns[name][offsets[i]:offsets[i + 1]]).decode()
+
+
+def load_shard(path):
+    """
+    :param path: the path of the shard
+    :type path: str
+
+    :return: the memory mapped shard
+    :rtype: Shard
+    """
+    with open(path, 'rb') as shard_file:
+        return Shard(path, shard_file)
+
+
+def get_shard_paths(directory):
+    """
+    :param directory: the directory of the shards
+    :type directory: str
+
+    :return: the paths of the shards in the order they were written
+    :rtype: list[str]
+    """
+    return sorted(join(directory, name) for name in os.listdir(directory)
+                  if re.match(r"records_\d+\.shard$", name))
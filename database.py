@@ -0,0 +1,430 @@
+"""
+Access to the database the sensor and line data is saved in
+
+A backend provides the two lookups the synchronizer needs:
+fetch_speeds: the newest speeds of lines before or after a time
+get_sensor_rows: the rows of a database sensor around a time window
+
+MysqlBackend queries the mysql database, SqliteBackend a sqlite copy of it and LocalBackend replays tables
+exported as csv files from sorted in-memory arrays without any round trips.
+"""
+import bisect
+import csv
+import datetime
+import logging
+import queue
+import re
+import sqlite3
+import threading
+
+from array import array
+from contextlib import contextmanager
+from os.path import join
+
+from timings import to_microseconds
+
+datetime_pattern = re.compile(r"^\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d+)?$")
+
+
+def execute_query(connection, query, params=None):
+    """
+    Executes a single mysql query
+    :param connection:  the database to execute the query on
+    :param query: the actual query
+    :param params: the values of the %s placeholders of the query
+    :type connection: MySQLConnection
+    :type query: str
+    :type params: tuple
+
+    :return: the query result
+    :rtype: list[dict]
+    """
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(query, params)
+    result = cursor.fetchall()
+    cursor.close()
+    return result
+
+
+def stream_query(connection, query, params):
+    """
+    Executes a single parameterized mysql query as prepared statement and streams the rows without
+    buffering the whole result
+    :param connection: the database to execute the query on
+    :param query: the query with %s placeholders
+    :param params: the values of the placeholders
+    :type connection: MySQLConnection
+    :type query: str
+    :type params: tuple
+
+    :return: generator of the result rows
+    :rtype: collections.Iterable[tuple]
+    """
+    cursor = connection.cursor(prepared=True)
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def get_sensor_columns(sensor):
+    """
+    :param sensor: the database sensor dictionary
+    :type sensor: dict
+
+    :return: the columns selected for a database sensor (None for all columns)
+    :rtype: list[str]
+    """
+    if ('field_name' in sensor['location']):
+        return [sensor['location']['field_name'], sensor['condition']['datediff']['field_name']]
+    return None
+
+
+class Backend(object):
+    """
+    The interface of the sources of the speeds and the database sensors
+    """
+
+    def fetch_speeds(self, requests, newer):
+        """
+        Fetch the speeds of multiple lines at once
+
+        :param requests: tuples (item name, maximum amount of speeds, time bound or None)
+        :param newer: True to fetch the newest speeds after the time bound, False for the newest ones before it
+        :type requests: list[tuple[str, int, datetime.datetime]]
+        :type newer: bool
+
+        :return: the read times in microseconds since epoch and the raw values of every request,
+            newest speed first
+        :rtype: list[tuple[array, array]]
+        """
+        raise NotImplementedError()
+
+    def get_sensor_rows(self, sensor, start, end):
+        """
+        Get the rows of a database sensor from the last one at or before start to the last one before end
+
+        :param sensor: the database sensor dictionary (with a datediff condition)
+        :param start: the start of the time window
+        :param end: the end of the time window (exclusive)
+        :type sensor: dict
+        :type start: datetime.datetime
+        :type end: datetime.datetime
+
+        :return: the rows sorted by time. The time is the second column of a row
+        :rtype: list[dict]
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MysqlBackend(Backend):
+    """
+    Queries the mysql database
+    """
+
+    def __init__(self, connection):
+        """
+        :param connection: the database connection
+        :type connection: MySQLConnection
+        """
+        self.connection = connection
+
+    def _execute(self, query, params):
+        return execute_query(self.connection, query, params)
+
+    def close(self):
+        self.connection.close()
+
+    def _stream(self, query, params):
+        return stream_query(self.connection, query, params)
+
+    def fetch_speeds(self, requests, newer):
+        # a LIMIT for every line, so every line gets its own derived table
+        queries = []
+        params = []
+        for i, (item_name, count, bound) in enumerate(requests):
+            query = "SELECT ITEM_NAME, ITEM_VALUE, READ_TIME FROM `opc_data` WHERE `ITEM_NAME` = %s "
+            params.append(item_name)
+            if (bound is not None):
+                query += "AND READ_TIME %s %%s " % ('>' if newer else '<')
+                params.append(bound)
+            query += "ORDER BY READ_TIME DESC LIMIT %s"
+            params.append(count)
+            queries.append("SELECT * FROM (%s) AS line_%d" % (query, i))
+        query = " UNION ALL ".join(queries) + " ORDER BY READ_TIME DESC"
+
+        speeds = dict((request[0], (array('q'), array('d'))) for request in requests)
+        for item_name, value, read_time in self._stream(query, tuple(params)):
+            if (isinstance(item_name, (bytes, bytearray))):
+                item_name = item_name.decode()
+            speeds[item_name][0].append(to_microseconds(read_time))
+            speeds[item_name][1].append(float(value))
+
+        logging.debug("Executed query \"%s\" with %s and got %d results", query, params,
+                      sum(len(times) for times, _ in speeds.values()))
+        return [speeds[request[0]] for request in requests]
+
+    def get_sensor_rows(self, sensor, start, end):
+        date_field = sensor['condition']['datediff']['field_name']
+        columns = get_sensor_columns(sensor)
+        field_condition = ""
+        field_params = ()
+        if ('field' in sensor['condition']):
+            field_condition = "%s = %%s AND " % sensor['condition']['field']['field_name']
+            field_params = (sensor['condition']['field']['value'],)
+
+        # all rows from the last one before the start to the end
+        query = "SELECT %s FROM %s WHERE %s%s >= COALESCE((SELECT MAX(%s) FROM %s WHERE %s%s <= %%s), %%s) " \
+                "AND %s < %%s ORDER BY %s" % (
+                    "*" if columns is None else ", ".join(columns), sensor['specification'], field_condition,
+                    date_field, date_field, sensor['specification'], field_condition, date_field, date_field,
+                    date_field)
+        params = field_params + field_params + (start, start, end)
+
+        logging.debug("Execute query %a with %s", query, params)
+        return self._execute(query, params)
+
+
+def to_sqlite_value(value):
+    if (isinstance(value, datetime.datetime)):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return value
+
+
+def from_sqlite_value(value):
+    if (isinstance(value, str) and datetime_pattern.match(value)):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+class SqliteBackend(MysqlBackend):
+    """
+    Queries a sqlite copy of the database. The datetimes are saved as text in the format "%Y-%m-%d %H:%M:%S.%f"
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the sqlite database
+        :type path: str
+        """
+        super().__init__(sqlite3.connect(path, check_same_thread=False))
+
+    def _cursor(self, query, params):
+        cursor = self.connection.cursor()
+        cursor.execute(query.replace("%s", "?"), [to_sqlite_value(param) for param in params])
+        return cursor
+
+    def _execute(self, query, params):
+        cursor = self._cursor(query, params)
+        columns = [column[0] for column in cursor.description]
+        result = [dict(zip(columns, map(from_sqlite_value, row))) for row in cursor.fetchall()]
+        cursor.close()
+        return result
+
+    def _stream(self, query, params):
+        cursor = self._cursor(query, params)
+        try:
+            for row in cursor:
+                yield tuple(map(from_sqlite_value, row))
+        finally:
+            cursor.close()
+
+
+def get_converter(value):
+    """
+    :param value: a value of an exported table
+    :type value: str
+
+    :return: the function converting the values of the column of the value
+    :rtype: function
+    """
+    for converter in (int, float):
+        try:
+            converter(value)
+            return converter
+        except ValueError:
+            pass
+    if (datetime_pattern.match(value)):
+        return datetime.datetime.fromisoformat
+    return str
+
+
+class LocalBackend(Backend):
+    """
+    Replays tables exported from the database (csv files named like the table with a header row) from memory.
+    Every table is loaded on first use, its rows are sorted by time for every sensor and line
+    """
+
+    def __init__(self, location, delimiter=','):
+        """
+        :param location: the directory of the exported tables
+        :param delimiter: the delimiter of the csv files
+        :type location: str
+        :type delimiter: str
+        """
+        self.location = location
+        self.delimiter = delimiter
+        # table name -> (column names, columns)
+        self._tables = {}
+        # (table name, date field, field name, field value) -> (sorted times in microseconds, row numbers)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _load_table(self, table):
+        path = join(self.location, table + ".csv")
+        logging.info("Loading table %s from %s", table, path)
+        with open(path, 'r', newline='') as table_file:
+            csv_reader = csv.reader(table_file, delimiter=self.delimiter)
+            names = next(csv_reader)
+            columns = [[] for _ in names]
+            converters = [None] * len(names)
+            for row in csv_reader:
+                for column_no, value in enumerate(row):
+                    if (value == ''):
+                        columns[column_no].append(None)
+                        continue
+                    try:
+                        columns[column_no].append(converters[column_no](value))
+                    except (TypeError, ValueError):
+                        # first value of the column or e.g. an int column containing floats
+                        converters[column_no] = get_converter(value)
+                        columns[column_no].append(converters[column_no](value))
+        logging.debug("Loaded %d rows of table %s", len(columns[0]) if columns else 0, table)
+        return names, columns
+
+    def _get_series(self, table, date_field, field_name=None, value=None):
+        key = (table, date_field, field_name, value)
+        with self._lock:
+            if (key not in self._series):
+                if (table not in self._tables):
+                    self._tables[table] = self._load_table(table)
+                names, columns = self._tables[table]
+                times = columns[names.index(date_field)]
+                row_numbers = range(len(times))
+                if (field_name is not None):
+                    field = columns[names.index(field_name)]
+                    row_numbers = [i for i in row_numbers if field[i] == value]
+                row_numbers = sorted(row_numbers, key=lambda i: times[i])
+                self._series[key] = (array('q', [to_microseconds(times[i]) for i in row_numbers]),
+                                     array('q', row_numbers))
+            return self._tables[table], self._series[key]
+
+    def fetch_speeds(self, requests, newer):
+        speeds = []
+        for item_name, count, bound in requests:
+            (names, columns), (times, row_numbers) = self._get_series('opc_data', 'READ_TIME', 'ITEM_NAME', item_name)
+            values = columns[names.index('ITEM_VALUE')]
+            if (newer):
+                end = len(times)
+                start = max(bisect.bisect_right(times, to_microseconds(bound)), end - count)
+            else:
+                end = len(times) if bound is None else bisect.bisect_left(times, to_microseconds(bound))
+                start = max(0, end - count)
+            speeds.append((array('q', reversed(times[start:end])),
+                           array('d', [float(values[i]) for i in reversed(row_numbers[start:end])])))
+        return speeds
+
+    def get_sensor_rows(self, sensor, start, end):
+        date_field = sensor['condition']['datediff']['field_name']
+        if ('field' in sensor['condition']):
+            series = self._get_series(sensor['specification'], date_field,
+                                      sensor['condition']['field']['field_name'],
+                                      sensor['condition']['field']['value'])
+        else:
+            series = self._get_series(sensor['specification'], date_field)
+        (names, columns), (times, row_numbers) = series
+
+        # all rows from the last one before the start to the end
+        first = bisect.bisect_right(times, to_microseconds(start)) - 1
+        if (first < 0):
+            first = 0
+        else:
+            first = bisect.bisect_left(times, times[first])
+        last = bisect.bisect_left(times, to_microseconds(end))
+
+        selected = get_sensor_columns(sensor) or names
+        selected_columns = [columns[names.index(name)] for name in selected]
+        return [dict(zip(selected, [column[i] for column in selected_columns])) for i in row_numbers[first:last]]
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of database connections shared between threads. Connections are opened on demand
+    up to the size of the pool, if all of them are in use connection() blocks until one is returned
+    """
+
+    def __init__(self, connect, size):
+        """
+        :param connect: opens a new connection
+        :param size: the maximum amount of open connections
+        :type connect: () -> Backend
+        :type size: int
+        """
+        self._connect = connect
+        self._size = size
+        self._opened = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def add(self, connection):
+        """
+        Add an already opened connection to the pool
+
+        :param connection: the connection
+        :type connection: Backend
+        """
+        with self._lock:
+            self._opened += 1
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block
+
+        :return: the connection
+        :rtype: Backend
+        """
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            open_new = self._opened < self._size
+            if (open_new):
+                self._opened += 1
+        if (not open_new):
+            return self._idle.get()
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def close(self):
+        """
+        Close all connections that are not in use
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._opened -= 1
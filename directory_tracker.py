@@ -0,0 +1,208 @@
+"""
+Incremental tracking of the files of a directory
+
+Sensors keep writing files during a shift, so the indexes of their directories are updated from the changes
+since the last poll instead of listing and stat'ing every file per query:
+- the directory is only listed again if its mtime changed (files were added, removed or renamed)
+- only new files and active files (modified within settle_time or the newest file) are stat'ed, because an
+  append to a file doesn't change the mtime of its directory. Settled files are taken from the snapshot
+- a settled file replaced under the same name is recognized by its inode, which scandir returns without a stat
+- every rescan_interval all files are stat'ed again, in case a settled file was appended to
+
+A file which shrank or was rewritten is reported as removed and added.
+"""
+import os
+import time
+
+# seconds after their last modification files are expected not to grow anymore
+settle_time = 60.0
+# seconds between two polls stat'ing all files (0 to never stat settled files again)
+rescan_interval = 300.0
+# seconds the mtime of a directory has to be older than the poll to be trusted: the directory could change again
+# within the resolution of its mtime
+racy_interval = 1.0
+
+
+class FileState(object):
+    """
+    The size, modification time and inode of a file (None if unknown)
+    """
+    __slots__ = ('size', 'mtime', 'inode')
+
+    def __init__(self, size, mtime, inode=None):
+        """
+        :param size: the size in bytes
+        :param mtime: the modification time in ns since epoch
+        :param inode: the inode number
+        :type size: int
+        :type mtime: int
+        :type inode: int
+        """
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+
+
+class DirectoryChanges(object):
+    """
+    The names of the files added, grown and removed since the previous poll
+    """
+    __slots__ = ('added', 'grown', 'removed')
+
+    def __init__(self):
+        self.added = []
+        self.grown = []
+        self.removed = []
+
+    def __bool__(self):
+        return len(self.added) > 0 or len(self.grown) > 0 or len(self.removed) > 0
+
+    def __len__(self):
+        return len(self.added) + len(self.grown) + len(self.removed)
+
+    def __repr__(self):
+        return "DirectoryChanges(added=%d, grown=%d, removed=%d)" % (
+            len(self.added), len(self.grown), len(self.removed))
+
+
+class DirectoryTracker(object):
+    """
+    A snapshot of the files of a directory, which is updated by poll
+    """
+
+    def __init__(self, location, accept=None, rescan=True):
+        """
+        :param location: the directory
+        :param accept: a function returning True for the names of the files to track (default all files)
+        :param rescan: stat all files every rescan_interval (not needed for files which are written once)
+        :type location: str
+        :type accept: function
+        :type rescan: bool
+        """
+        self.location = location
+        self.accept = accept
+        self.rescan = rescan
+        self.directory_mtime = None
+        # file name -> FileState of all tracked files
+        self.files = {}
+        # names of the files stat'ed on every poll
+        self._active = set()
+        # names of the restored files, which are stat'ed on the next listing
+        self._unverified = set()
+        self._last_rescan = time.monotonic()
+
+    def __len__(self):
+        return len(self.files)
+
+    def restore(self, files, directory_mtime=None, verify=True):
+        """
+        Take the files of a saved index as snapshot, so they aren't reported as added
+
+        :param files: file name -> FileState of the saved files
+        :param directory_mtime: the mtime of the directory when the index was saved (None to list the directory
+            on the next poll)
+        :param verify: stat the files on the next listing of the directory (they could have changed since),
+            otherwise they are taken as settled
+        :type files: dict[str, FileState]
+        :type directory_mtime: int
+        :type verify: bool
+        """
+        self.files.update(files)
+        self.directory_mtime = directory_mtime
+        if (verify):
+            self._unverified.update(files)
+
+    def _stat(self, name, changes, now):
+        """
+        Stat a file and compare it with its previous state
+
+        :return: the new state or None if the file doesn't exist anymore
+        :rtype: FileState
+        """
+        try:
+            stat = os.stat(os.path.join(self.location, name))
+        except FileNotFoundError:
+            return None
+        state = FileState(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        previous = self.files.get(name)
+        if (previous is None):
+            changes.added.append(name)
+        elif (previous.size is None or previous.mtime is None):
+            pass
+        elif (state.size > previous.size):
+            changes.grown.append(name)
+        elif (state.size < previous.size or state.mtime != previous.mtime or
+              (previous.inode is not None and state.inode != previous.inode)):
+            changes.removed.append(name)
+            changes.added.append(name)
+
+        if (now - state.mtime < settle_time * 1e9):
+            self._active.add(name)
+        else:
+            self._active.discard(name)
+        return state
+
+    def _list(self, changes, now):
+        """
+        List the directory, stat the new, replaced, unverified and active files and take the rest from the snapshot
+        """
+        files = {}
+        with os.scandir(self.location) as entries:
+            for entry in entries:
+                if (not entry.is_file() or (self.accept is not None and not self.accept(entry.name))):
+                    continue
+                previous = self.files.get(entry.name)
+                if (previous is not None and previous.inode is not None and previous.inode != entry.inode()):
+                    # replaced by another file with the same name
+                    del self.files[entry.name]
+                    changes.removed.append(entry.name)
+                    previous = None
+                if (previous is None or entry.name in self._active or entry.name in self._unverified):
+                    state = self._stat(entry.name, changes, now)
+                    if (state is None):
+                        continue
+                else:
+                    state = previous
+                    if (state.inode is None):
+                        state.inode = entry.inode()
+                files[entry.name] = state
+
+        changes.removed.extend(name for name in self.files if (name not in files))
+        self._active.intersection_update(files)
+        self._unverified.clear()
+        self.files = files
+
+    def poll(self):
+        """
+        Update the snapshot
+
+        :return: the changes since the previous poll
+        :rtype: DirectoryChanges
+        """
+        changes = DirectoryChanges()
+        now = time.time_ns()
+        directory_mtime = os.stat(self.location).st_mtime_ns
+        if (self.rescan and rescan_interval > 0 and time.monotonic() - self._last_rescan >= rescan_interval):
+            self._active.update(self.files)
+            self._last_rescan = time.monotonic()
+
+        if (directory_mtime != self.directory_mtime):
+            self._list(changes, now)
+        else:
+            for name in list(self._active):
+                state = self._stat(name, changes, now)
+                if (state is None):
+                    # removed without changing the mtime of the directory (e.g. within its resolution)
+                    del self.files[name]
+                    self._active.discard(name)
+                    changes.removed.append(name)
+                else:
+                    self.files[name] = state
+
+        # the newest file is the one most likely still written
+        if (len(self.files) > 0 and len(self._active) == 0):
+            newest = max(self.files, key=lambda name: self.files[name].mtime or 0)
+            self._active.add(newest)
+
+        self.directory_mtime = directory_mtime if (now - directory_mtime >= racy_interval * 1e9) else None
+        return changes
@@ -0,0 +1,94 @@
+"""
+Cache of parsed analyser images
+
+Nearby capture times often resolve to the same or to adjacent images, so the parsed images are kept in memory
+across lookups. The images are identified by their file, id and datetime and the least recently used images
+are evicted once the loci of the cached images exceed the byte budget. Only complete images are cached,
+an incomplete image could still be completed by a following file.
+"""
+import threading
+
+from collections import OrderedDict
+
+import metrics
+
+# the maximum amount of bytes of the loci of the cached images (0 to disable the cache)
+cache_size = 64 * 1024 * 1024
+# the amount of images before and after a missed image that are parsed and cached with it (if they are in the
+# same file and not cached yet)
+window = 2
+
+
+class ImageCache(object):
+    """
+    A LRU cache of parsed images bounded by the size of their loci
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (path, image id, image datetime) -> AnalyserImage, the least recently used first
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def get(self, key):
+        """
+        :param key: the file, id and datetime of the image
+        :type key: tuple[str, int, datetime.datetime]
+
+        :return: the cached image or None if it isn't cached
+        :rtype: AnalyserImage
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if (image is None):
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+        metrics.count("image_cache.misses" if (image is None) else "image_cache.hits")
+        return image
+
+    def put(self, key, image):
+        """
+        :param key: the file, id and datetime of the image
+        :param image: the complete image
+        :type key: tuple[str, int, datetime.datetime]
+        :type image: AnalyserImage
+        """
+        if (cache_size <= 0):
+            return
+        size = image.get_size()
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if (previous is not None):
+                self.size -= previous.get_size()
+            self._images[key] = image
+            self.size += size
+            while (self.size > cache_size and len(self._images) > 0):
+                _, evicted = self._images.popitem(last=False)
+                self.size -= evicted.get_size()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
+
+
+_cache = ImageCache()
+
+
+def get_image_cache():
+    """
+    :return: the image cache shared by all lookups
+    :rtype: ImageCache
+    """
+    return _cache
@@ -0,0 +1,197 @@
+"""
+Memory mapped loading of kinect frames
+
+The frames are memory mapped instead of read, so only the pages a consumer accesses are loaded. The recently
+used frames are kept in a cache bounded by their size, and after a frame has been loaded its neighbours
+(the following frames and the previous one) are prefetched on a background thread, because batch and streaming
+synchronizations move through the frames in order.
+"""
+import logging
+import mmap
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import metrics
+
+# the maximum amount of bytes of the cached frames
+cache_size = 256 * 1024 * 1024
+# the amount of following frames prefetched after a frame has been loaded
+prefetch_count = 2
+
+# frame loaders (location -> FrameLoader)
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+class KinectFrame(object):
+    """
+    A memory mapped frame. Its data can be used like bytes (e.g. memoryview(frame.data))
+    """
+    __slots__ = ('name', 'path', 'data')
+
+    def __init__(self, name, path, data):
+        self.name = name
+        self.path = path
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "KinectFrame(%r, %d bytes)" % (self.name, len(self.data))
+
+
+def map_frame(path):
+    """
+    :param path: the path of the frame
+    :type path: str
+
+    :return: the memory mapped file (bytes for empty files, which can't be mapped)
+    :rtype: mmap.mmap|bytes
+    """
+    with open(path, 'rb') as frame_file:
+        if (os.fstat(frame_file.fileno()).st_size == 0):
+            return b''
+        return mmap.mmap(frame_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def touch_frame(data):
+    """
+    Load the pages of a memory mapped frame in advance
+
+    :param data: the memory mapped frame
+    :type data: mmap.mmap|bytes
+    """
+    if (not isinstance(data, mmap.mmap)):
+        return
+    if (hasattr(data, 'madvise') and hasattr(mmap, 'MADV_WILLNEED')):
+        data.madvise(mmap.MADV_WILLNEED)
+    else:
+        for offset in range(0, len(data), mmap.PAGESIZE):
+            data[offset]
+
+
+class FrameLoader(object):
+    """
+    Loads the frames of a kinect directory through a size bounded LRU cache
+    """
+
+    def __init__(self, location):
+        """
+        :param location: the kinect directory
+        :type location: str
+        """
+        self.location = location
+        self.size = 0
+        # file name -> KinectFrame, the least recently used first
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetching = set()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _get(self, name):
+        with self._lock:
+            frame = self._frames.get(name)
+            if (frame is not None):
+                self._frames.move_to_end(name)
+                return frame
+
+        path = join(self.location, name)
+        frame = KinectFrame(name, path, map_frame(path))
+        with self._lock:
+            if (name not in self._frames):
+                self._frames[name] = frame
+                self.size += len(frame)
+                # the mappings are not closed, a consumer could still use them
+                while (self.size > cache_size and len(self._frames) > 1):
+                    _, evicted = self._frames.popitem(last=False)
+                    self.size -= len(evicted)
+            return self._frames.get(name, frame)
+
+    def _prefetch(self, name):
+        try:
+            touch_frame(self._get(name).data)
+        except OSError as e:
+            logging.debug("Couldn't prefetch %s: %s", name, e)
+        finally:
+            with self._lock:
+                self._prefetching.discard(name)
+
+    def load(self, names, i):
+        """
+        Load a frame and prefetch its neighbours
+
+        :param names: the names of the frames in order (see KinectIndex.names)
+        :param i: the position of the frame to load
+        :type names: list[str]
+        :type i: int
+
+        :return: the frame
+        :rtype: KinectFrame
+        """
+        with self._lock:
+            cached = names[i] in self._frames
+        metrics.count("kinect_frames.cache_hits" if (cached) else "kinect_frames.loaded")
+        frame = self._get(names[i])
+
+        for neighbour in [i - 1] + list(range(i + 1, i + 1 + prefetch_count)):
+            if (neighbour < 0 or neighbour >= len(names)):
+                continue
+            with self._lock:
+                if (names[neighbour] in self._frames or names[neighbour] in self._prefetching):
+                    continue
+                self._prefetching.add(names[neighbour])
+            self._executor.submit(self._prefetch, names[neighbour])
+        return frame
+
+    def close(self):
+        """
+        Stop prefetching and empty the cache
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._frames.clear()
+            self.size = 0
+
+
+def get_frame_loader(location):
+    """
+    :param location: the kinect directory
+    :type location: str
+
+    :return: the frame loader of the directory
+    :rtype: FrameLoader
+    """
+    with _loaders_lock:
+        loader = _loaders.get(location)
+        if (loader is None):
+            loader = FrameLoader(location)
+            _loaders[location] = loader
+        return loader
+
+
+def load_closest_frames(sensor, index, timestamp):
+    """
+    :param sensor: the kinect sensor dictionary
+    :param index: the up to date frame index of the sensor
+    :param timestamp: the timestamp
+    :type sensor: dict
+    :type index: kinect_index.KinectIndex
+    :type timestamp: datetime.datetime
+
+    :return: the frame closest to the timestamp of every file prefix (None if there are no frames)
+    :rtype: list[KinectFrame]
+    """
+    loader = get_frame_loader(sensor['location'])
+    frames = []
+    for file_prefix in sensor['file_prefixes']:
+        i = index.find_closest_position(file_prefix, timestamp)
+        frames.append(None if (i is None) else loader.load(index.names[file_prefix], i))
+    return frames
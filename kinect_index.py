@@ -0,0 +1,213 @@
+"""
+Index of the frames in a kinect directory
+
+The modification times of all frames are saved in the hidden directory ".index" of the kinect directory.
+The index is only refreshed if the modification time of the directory changed, and only the frames
+added or removed since then are stat'ed (see directory_tracker.py). Frames are expected to be written once,
+a frame still written while it was added is updated when it grew.
+
+structure of an index file:
+#;directory mtime in ns
+file name;file mtime in seconds since epoch
+...
+"""
+import bisect
+import csv
+import logging
+import os
+
+from array import array
+from os.path import join
+
+import metrics
+
+from analyser_index import index_directory
+from directory_tracker import DirectoryTracker, FileState
+
+index_file_name = "kinect.idx"
+
+# loaded indexes ((location, file prefixes) -> KinectIndex)
+_indexes = {}
+
+
+class KinectIndex(object):
+    """
+    The frames of a kinect directory sorted by their time of modification for every file prefix
+    """
+    __slots__ = ('location', 'prefixes', 'tracker', 'mtimes', 'times', 'names')
+
+    def __init__(self, location, prefixes):
+        """
+        :param location: the kinect directory
+        :param prefixes: the prefixes of the frame files
+        :type location: str
+        :type prefixes: list[str]
+        """
+        self.location = location
+        self.prefixes = prefixes
+        self.tracker = DirectoryTracker(location, rescan=False)
+        # file name -> mtime of all files
+        self.mtimes = {}
+        # prefix -> sorted mtimes / file names
+        self.times = dict((prefix, array('d')) for prefix in prefixes)
+        self.names = dict((prefix, []) for prefix in prefixes)
+
+    def _sort(self):
+        for prefix in self.prefixes:
+            frames = sorted((mtime, name) for name, mtime in self.mtimes.items() if name.startswith(prefix))
+            self.times[prefix] = array('d', [frame[0] for frame in frames])
+            self.names[prefix] = [frame[1] for frame in frames]
+
+    def refresh(self):
+        """
+        Add the new frames of the directory and remove the deleted ones
+
+        :return: True if the frames changed
+        :rtype: bool
+        """
+        with metrics.span("kinect_index.scan"):
+            changes = self.tracker.poll()
+        if (not changes):
+            metrics.count("kinect_index.cache_hits")
+            return False
+
+        for name in changes.removed:
+            self.mtimes.pop(name, None)
+        added = []
+        for name in changes.added + changes.grown:
+            state = self.tracker.files.get(name)
+            if (state is not None):
+                self.mtimes[name] = state.mtime / 1e9
+                added.append((self.mtimes[name], name))
+        logging.debug("Kinect index of %s: %d frames added, %d grown, %d removed", self.location,
+                      len(changes.added), len(changes.grown), len(changes.removed))
+
+        added.sort()
+        if (len(changes.removed) == 0 and len(changes.grown) == 0 and
+                all(len(self.times[prefix]) == 0 or mtime >= self.times[prefix][-1]
+                    for mtime, name in added for prefix in self.prefixes if name.startswith(prefix))):
+            # the usual case: new frames are newer than all known frames
+            for mtime, name in added:
+                for prefix in self.prefixes:
+                    if (name.startswith(prefix)):
+                        self.times[prefix].append(mtime)
+                        self.names[prefix].append(name)
+        else:
+            self._sort()
+        return True
+
+    def find_closest_position(self, prefix, timestamp):
+        """
+        :param prefix: the file prefix of the frame
+        :param timestamp: the timestamp
+        :type prefix: str
+        :type timestamp: datetime.datetime
+
+        :return: the position of the frame closest to the timestamp in names[prefix] (the earlier one if two are
+            equally close) or None if there are no frames
+        :rtype: int
+        """
+        times = self.times[prefix]
+        if (len(times) == 0):
+            return None
+
+        target = timestamp.timestamp()
+        i = bisect.bisect_left(times, target)
+        if (i == len(times) or (i > 0 and target - times[i - 1] <= times[i] - target)):
+            i -= 1
+        return i
+
+    def find_closest(self, prefix, timestamp):
+        """
+        :param prefix: the file prefix of the frame
+        :param timestamp: the timestamp
+        :type prefix: str
+        :type timestamp: datetime.datetime
+
+        :return: the name of the frame closest to the timestamp (the earlier one if two are equally close)
+            or None if there are no frames
+        :rtype: str
+        """
+        i = self.find_closest_position(prefix, timestamp)
+        if (i is None):
+            return None
+        return self.names[prefix][i]
+
+
+def get_index_path(location):
+    """
+    :param location: the kinect directory
+    :type location: str
+
+    :return: the path of the index of the directory
+    :rtype: str
+    """
+    return join(location, index_directory, index_file_name)
+
+
+def save_index(index):
+    """
+    :param index: the index to save in its directory
+    :type index: KinectIndex
+    """
+    index_path = get_index_path(index.location)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+    temp_path = index_path + ".tmp"
+    with open(temp_path, 'w', newline='') as index_file:
+        csv_writer = csv.writer(index_file, delimiter=';')
+        # -1 if the mtime of the directory was too recent to be trusted
+        directory_mtime = index.tracker.directory_mtime
+        csv_writer.writerow(['#', -1 if (directory_mtime is None) else directory_mtime])
+        csv_writer.writerows((name, repr(mtime)) for name, mtime in index.mtimes.items())
+    os.replace(temp_path, index_path)
+
+
+def load_index(location, prefixes):
+    """
+    :param location: the kinect directory
+    :param prefixes: the prefixes of the frame files
+    :type location: str
+    :type prefixes: list[str]
+
+    :return: the index as it has been saved (it can be outdated) or an empty index if there is none
+    :rtype: KinectIndex
+    """
+    index = KinectIndex(location, prefixes)
+    index_path = get_index_path(location)
+    if (not os.path.isfile(index_path)):
+        return index
+
+    with open(index_path, 'r', newline='') as index_file:
+        csv_reader = csv.reader(index_file, delimiter=';')
+        header = next(csv_reader, None)
+        if (header is None):
+            return index
+        directory_mtime = int(header[1])
+        for row in csv_reader:
+            index.mtimes[row[0]] = float(row[1])
+    # the frames are written once, so they aren't stat'ed again
+    index.tracker.restore(dict((name, FileState(None, round(mtime * 1e9))) for name, mtime in index.mtimes.items()),
+                          None if (directory_mtime < 0) else directory_mtime, verify=False)
+    index._sort()
+    return index
+
+
+def get_kinect_index(sensor):
+    """
+    Get the up to date frame index of a kinect sensor
+
+    :param sensor: the kinect sensor dictionary
+    :type sensor: dict
+
+    :return: the index
+    :rtype: KinectIndex
+    """
+    key = (sensor['location'], tuple(sensor['file_prefixes']))
+    index = _indexes.get(key)
+    if (index is None):
+        index = load_index(sensor['location'], sensor['file_prefixes'])
+        _indexes[key] = index
+    if (index.refresh()):
+        save_index(index)
+    return index
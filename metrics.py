@@ -0,0 +1,226 @@
+"""
+Lightweight spans and counters of the hot paths
+
+A span times a stage (database queries, directory scans, file parses, offset computations, sensors),
+a counter sums up e.g. the rows scanned, the bytes read or the cache hits. The collected metrics of a run
+are exported as json summary or in the Prometheus text format. Single stages can be run under cProfile
+(the statistics are dumped next to the export) or tracemalloc (the peak memory is recorded as gauge).
+
+structure of the json summary:
+{
+    'spans': {span name: {'count': int, 'seconds': float, 'max_seconds': float}, ...},
+    'counters': {counter name: int, ...},
+    'gauges': {gauge name: float, ...}
+}
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+# =================
+# = Configuration =
+# =================
+
+enabled = True  # collect metrics
+export_path = "log/metrics.json"  # the file the metrics are exported to (.prom for the Prometheus text format)
+profile_stages = []  # the names of the spans run under cProfile
+trace_memory_stages = []  # the names of the spans whose peak memory is traced
+
+# the collected metrics
+_spans = {}
+_counters = {}
+_gauges = {}
+_profiles = {}
+_lock = threading.Lock()
+# only one stage can run under cProfile at a time
+_profiling = False
+
+
+class Span(object):
+    """
+    The duration of a single run of a stage
+    """
+    __slots__ = ('name', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+
+
+def _start_profile(name):
+    global _profiling
+    with _lock:
+        if (_profiling):
+            return None
+        _profiling = True
+        profile = _profiles.setdefault(name, cProfile.Profile())
+    profile.enable()
+    return profile
+
+
+def _stop_profile(profile):
+    global _profiling
+    profile.disable()
+    with _lock:
+        _profiling = False
+
+
+@contextmanager
+def span(name):
+    """
+    Time a stage
+
+    :param name: the name of the stage
+    :type name: str
+
+    :return: the span, its duration is set when the stage is finished
+    :rtype: Span
+    """
+    current = Span(name)
+    if (not enabled):
+        yield current
+        return
+
+    profile = _start_profile(name) if (name in profile_stages) else None
+    trace_memory = name in trace_memory_stages
+    if (trace_memory):
+        if (not tracemalloc.is_tracing()):
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        if (profile is not None):
+            _stop_profile(profile)
+        with _lock:
+            stats = _spans.get(name)
+            if (stats is None):
+                _spans[name] = stats = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            stats['count'] += 1
+            stats['seconds'] += current.seconds
+            stats['max_seconds'] = max(stats['max_seconds'], current.seconds)
+            if (trace_memory):
+                peak_name = name + ".peak_bytes"
+                _gauges[peak_name] = max(_gauges.get(peak_name, 0), tracemalloc.get_traced_memory()[1])
+
+
+def count(name, value=1):
+    """
+    Increase a counter
+
+    :param name: the name of the counter
+    :param value: the amount to add
+    :type name: str
+    :type value: int
+    """
+    if (not enabled):
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """
+    :param name: the name of the gauge
+    :param value: the current value
+    :type name: str
+    :type value: float
+    """
+    if (not enabled):
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def reset():
+    """
+    Remove all collected metrics
+    """
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _gauges.clear()
+        _profiles.clear()
+
+
+def summary():
+    """
+    :return: the collected metrics (see the structure of the json summary)
+    :rtype: dict
+    """
+    with _lock:
+        return {'spans': dict((name, dict(stats)) for name, stats in _spans.items()),
+                'counters': dict(_counters),
+                'gauges': dict(_gauges)}
+
+
+def get_metric_name(name):
+    """
+    :param name: the name of a span or counter
+    :type name: str
+
+    :return: the name as Prometheus metric name
+    :rtype: str
+    """
+    return "synchsensordata_" + "".join(c if c.isalnum() else "_" for c in name).lower()
+
+
+def to_prometheus(metrics):
+    """
+    :param metrics: the collected metrics (see summary)
+    :type metrics: dict
+
+    :return: the metrics in the Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    for name, stats in sorted(metrics['spans'].items()):
+        metric_name = get_metric_name(name)
+        lines.append("# TYPE %s_seconds summary" % metric_name)
+        lines.append("%s_seconds_count %d" % (metric_name, stats['count']))
+        lines.append("%s_seconds_sum %r" % (metric_name, stats['seconds']))
+        lines.append("# TYPE %s_max_seconds gauge" % metric_name)
+        lines.append("%s_max_seconds %r" % (metric_name, stats['max_seconds']))
+    for name, value in sorted(metrics['counters'].items()):
+        lines.append("# TYPE %s_total counter" % get_metric_name(name))
+        lines.append("%s_total %d" % (get_metric_name(name), value))
+    for name, value in sorted(metrics['gauges'].items()):
+        lines.append("# TYPE %s gauge" % get_metric_name(name))
+        lines.append("%s %r" % (get_metric_name(name), value))
+    return "\n".join(lines) + "\n"
+
+
+def export(path=None):
+    """
+    Export the collected metrics and dump the profiles of the profiled stages next to them
+
+    :param path: the path of the export (default export_path). Paths ending with .prom are written
+        in the Prometheus text format, all others as json
+    :type path: str
+    """
+    if (not enabled):
+        return
+    if (path is None):
+        path = export_path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    metrics = summary()
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as export_file:
+        if (path.endswith(".prom")):
+            export_file.write(to_prometheus(metrics))
+        else:
+            json.dump(metrics, export_file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+    with _lock:
+        profiles = list(_profiles.items())
+    for name, profile in profiles:
+        profile.dump_stats(os.path.splitext(path)[0] + "_" + get_metric_name(name) + ".prof")
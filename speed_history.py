@@ -0,0 +1,161 @@
+"""
+In-memory history of the line speeds
+
+The speeds of every line are fetched only once. If the history is too short, only the rows older than
+the oldest cached speed are fetched from the database (keyset pagination on READ_TIME).
+The missing speeds of all lines are fetched at once from the backend (with a single prepared statement
+for mysql) into arrays per line.
+"""
+import logging
+
+import metrics
+
+from timings import SpeedProfile, from_microseconds
+
+
+class SpeedHistory(object):
+    """
+    The speed history of a single line
+    """
+    __slots__ = ('line', 'item_name', 'profile', 'exhausted')
+
+    def __init__(self, line, selector_template, tolerance=None):
+        """
+        :param line: the line dictionary
+        :param selector_template: the database template for data of the lines
+        :param tolerance: the tolerance to merge the speeds into segments with (see SpeedProfile)
+        :type line: dict
+        :type selector_template: str
+        :type tolerance: float
+        """
+        self.line = line
+        self.item_name = selector_template % {'line_name': line["database_name"], 'value_name': 'Istwert_Drehzahl'}
+        self.profile = SpeedProfile([], tolerance)
+        # True if the database has no older speeds
+        self.exhausted = False
+
+    def __len__(self):
+        # the amount of fetched speeds, the profile can hold less segments
+        return self.profile.samples
+
+    def get_request(self, count, newer=False):
+        """
+        :param count: the maximum amount of speeds to fetch
+        :param newer: True to fetch the speeds newer than the newest cached speed instead of older ones
+        :type count: int
+        :type newer: bool
+
+        :return: the request for the speeds of the line (see Backend.fetch_speeds)
+        :rtype: tuple[str, int, datetime.datetime]
+        """
+        if (newer):
+            return self.item_name, count, from_microseconds(self.profile.times[0])
+        elif (len(self) > 0):
+            return self.item_name, count, from_microseconds(self.profile.times[-1])
+        return self.item_name, count, None
+
+
+class SpeedHistories(object):
+    """
+    The speed histories of all lines
+    """
+    __slots__ = ('histories',)
+
+    def __init__(self, lines, tolerance=None):
+        """
+        :param lines: the line configuration
+        :param tolerance: the tolerance to merge the speeds into segments with (see SpeedProfile)
+        :type lines: dict
+        :type tolerance: float
+        """
+        self.histories = [SpeedHistory(line, lines["selector_template"], tolerance) for line in lines["lines"]]
+
+    @property
+    def profiles(self):
+        """
+        :return: the speed profiles of all lines. They are extended in place by fetch
+        :rtype: list[SpeedProfile]
+        """
+        return [history.profile for history in self.histories]
+
+    def fetch(self, db, limit):
+        """
+        Make sure the history of every line contains limit speeds. The missing older speeds of all lines are
+        fetched in one round trip
+
+        :param db: the database
+        :param limit: the amount of speeds every history should contain
+        :type db: database.Backend
+        :type limit: int
+        """
+        counts = dict((history.item_name, limit - len(history)) for history in self.histories
+                      if (len(history) < limit and not history.exhausted))
+        if (len(counts) == 0):
+            return
+        logging.info("Getting line speeds from database for %s", ', '.join(
+            [history.line['name'] for history in self.histories if history.item_name in counts]))
+
+        for history, times, speeds in self._fetch(db, counts, False):
+            history.profile.extend_raw(times, speeds)
+            if (len(times) < counts[history.item_name]):
+                history.exhausted = True
+
+    def fetch_newer(self, db, limit):
+        """
+        Add the speeds written to the database since the newest cached speed of every line.
+        If there are more than limit new speeds, the history of the line starts over with the newest ones
+
+        :param db: the database
+        :param limit: the maximum amount of new speeds per line
+        :type db: database.Backend
+        :type limit: int
+
+        :return: the amount of new speeds
+        :rtype: int
+        """
+        counts = dict((history.item_name, limit) for history in self.histories if len(history) > 0)
+        if (len(counts) == 0):
+            return 0
+
+        new_speeds = 0
+        for history, times, speeds in self._fetch(db, counts, True):
+            if (len(times) >= limit):
+                history.profile.truncate(0)
+                history.exhausted = False
+            history.profile.prepend_raw(times, speeds)
+            new_speeds += len(times)
+        return new_speeds
+
+    def truncate(self, limit):
+        """
+        Remove all but the newest limit speeds of every line to bound the memory
+
+        :param limit: the amount of speeds to keep per line
+        :type limit: int
+        """
+        for history in self.histories:
+            if (len(history) > limit):
+                history.profile.truncate(limit)
+                history.exhausted = False
+
+    def _fetch(self, db, counts, newer):
+        """
+        Fetch the speeds of multiple lines at once
+
+        :param db: the database
+        :param counts: the maximum amount of speeds for every item name
+        :param newer: True to fetch the speeds newer than the cached ones, False for older ones
+        :type db: database.Backend
+        :type counts: dict[str, int]
+        :type newer: bool
+
+        :return: list of tuples (history, times in microseconds since epoch, speeds in m/s)
+        :rtype: list[tuple[SpeedHistory, array, list[float]]]
+        """
+        histories = [history for history in self.histories if history.item_name in counts]
+        with metrics.span("database.fetch_speeds"):
+            speeds = db.fetch_speeds([history.get_request(counts[history.item_name], newer)
+                                      for history in histories], newer)
+        metrics.count("database.rows", sum(len(times) for times, _ in speeds))
+        return [(history, times, [value * history.line['speed_factor'] for value in values])
+                for history, (times, values) in zip(histories, speeds)]
@@ -1,34 +1,147 @@
-import csv
+"""
+Split large analyser files into smaller ones
+
+A file is only split at image boundaries (the first row whose id or datetime differs from the row before),
+so every image is in a single file and lookups never have to continue in the following file. The offset
+index (see analyser_index.py) of every part is collected while the part is written and saved next to it,
+and the parts are added to the manifest (see analyser_manifest.py) of the output directory, so the parts
+don't have to be scanned again before they can be used.
+
+usage:
+python split_file.py <analyser file> <pattern of the parts, e.g. parts/data_{0:03d}.csv> [size of a part in bytes]
+"""
+import logging
 import os
-import time
-from itertools import chain
-
-
-def split_file(path, pattern, size):
-    with open(path) as f:
-        for index, line in enumerate(f, start=1):
-            with open(pattern.format(index), 'w') as out:
-                n = 0
-                for line in chain([line], f):
-                    out.write(line)
-                    n += len(line)
-                    if n >= size:
-                        break
-
-
-if __name__ == "__main__":
-    dir = "C:/Users/Leonhard.Gahr/Documents/KIPro/2018-05-24-14-15-36-14_daten/udp_x102/2018_05_24/"
-    file_name = "kipro-analyser-data_2018-5-24_13-53-13.601.csv"
-    for file in os.listdir(dir):
-        if file != file_name:
-            os.remove(dir + file)
-    split_file(
-        dir + file_name,
-        dir + "kipro-analyser-data_{0:03d}.csv",
-        104857600/2)
-    start = time.time()
-    with open(dir + "kipro-analyser-data_001.csv") as file:
-        csv_reader = csv.reader(file, delimiter=';')
-        for row in csv_reader:
-            pass
-    print(time.time() - start)
+import sys
+
+from os.path import basename, dirname
+
+import analyser_manifest
+
+from analyser_blocks import open_data_file
+from analyser_chunks import get_line_key
+from analyser_index import AnalyserIndex, datetime_format, parse_datetime, save_index
+from analyser_manifest import ManifestEntry, load_manifest, save_manifest
+
+# the size of the read and write buffers
+buffer_size = 8 * 1024 * 1024
+default_part_size = 50 * 1024 * 1024
+
+
+def write_part(path, lines):
+    """
+    Write a part and its index
+
+    :param path: the path of the part
+    :param lines: the raw rows of the part. Its last image ends with the last row
+    :type path: str
+    :type lines: collections.Iterable[bytes]
+
+    :return: the index of the part
+    :rtype: AnalyserIndex
+    """
+    images = []
+    key = None
+    offset = 0
+    with open(path, 'wb', buffering=buffer_size) as part_file:
+        for line in lines:
+            part_file.write(line)
+            line_key = get_line_key(line)
+            if (line_key is not None):
+                if (line_key == key):
+                    images[-1][3] += 1
+                else:
+                    key = line_key
+                    images.append([int(line_key[0]), parse_datetime(line_key[1].decode()).strftime(datetime_format),
+                                   offset, 1, int(line.split(b';', 4)[3])])
+            offset += len(line)
+
+    stat = os.stat(path)
+    index = AnalyserIndex(path, stat.st_size, stat.st_mtime_ns)
+    for image in images:
+        index.append(*image)
+    save_index(index)
+    return index
+
+
+def iterate_images(source_file):
+    """
+    :param source_file: the analyser file opened in binary mode
+    :type source_file: io.BufferedReader
+
+    :return: the raw rows of every image
+    :rtype: collections.Iterable[list[bytes]]
+    """
+    image = []
+    key = None
+    for line in source_file:
+        line_key = get_line_key(line)
+        if (len(image) > 0 and (line_key is None or line_key != key)):
+            yield image
+            image = []
+        key = line_key
+        image.append(line)
+    if (len(image) > 0):
+        yield image
+
+
+def split_file(path, pattern, size=default_part_size):
+    """
+    Split an analyser file at image boundaries into parts of about the same size, index the parts
+    and add them to the manifest of their directory
+
+    :param path: the path of the analyser file
+    :param pattern: the path of the parts with a placeholder for the number of the part (starting with 1)
+    :param size: the minimum size of a part in bytes. A part ends with the first image ending after the size
+    :type path: str
+    :type pattern: str
+    :type size: int
+
+    :return: the paths of the parts
+    :rtype: list[str]
+    """
+    parts = []
+    indexes = []
+    with open_data_file(path, 'rb', buffering=buffer_size) as source_file:
+        images = iterate_images(source_file)
+
+        def iterate_part_lines(first_image):
+            written = 0
+            image = first_image
+            while (image is not None):
+                for line in image:
+                    written += len(line)
+                    yield line
+                if (written >= size):
+                    return
+                image = next(images, None)
+
+        for image in images:
+            part_path = pattern.format(len(parts) + 1)
+            os.makedirs(dirname(part_path) or ".", exist_ok=True)
+            indexes.append(write_part(part_path, iterate_part_lines(image)))
+            parts.append(part_path)
+            logging.debug("Wrote %d images to %s", len(indexes[-1]), part_path)
+
+    for location in set(dirname(part_path) for part_path in parts):
+        manifest = load_manifest(location)
+        names = set(basename(index.path) for index in indexes if dirname(index.path) == location)
+        manifest.entries = [entry for entry in manifest.entries if entry.name not in names]
+        for index in indexes:
+            if (dirname(index.path) == location and len(index) > 0):
+                manifest.entries.append(ManifestEntry(basename(index.path), parse_datetime(index.datetimes[0]),
+                                                      parse_datetime(index.datetimes[-1]), index.size, index.mtime))
+        manifest.entries.sort(key=lambda e: (e.first, e.name))
+        manifest.firsts = [entry.first for entry in manifest.entries]
+        save_manifest(manifest)
+        # the manifest is updated with the other files of the directory when it is loaded the next time
+        analyser_manifest._manifests.pop(location, None)
+    return parts
+
+
+if (__name__ == "__main__"):
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] [%(levelname)s] %(message)s')
+    if (len(sys.argv) not in (3, 4)):
+        print(__doc__)
+        sys.exit(1)
+    split_file(sys.argv[1], sys.argv[2], int(sys.argv[3]) if (len(sys.argv) == 4) else default_part_size)
@@ -0,0 +1,204 @@
+"""
+Streaming mode of the synchronizer
+
+Runs next to the conveyor: polls opc_data for speeds newer than the last seen READ_TIME and emits a
+synchronized record to a sink every time the material travelled emit_distance at current_position.
+The speed histories are kept up to date incrementally and bounded to max_history speeds per line,
+the analyser indexes only index the data appended since the last lookup.
+
+structure of a record:
+{
+    'time': the moment the material was at current_position,
+    'sensors': {sensor name: sensor data, ...}
+}
+"""
+import datetime
+import decimal
+import json
+import logging
+import socket
+import time
+
+from array import array
+from collections.abc import Mapping, Sequence
+
+import metrics
+import synchsensordata
+
+from columnar_sink import ColumnarSink
+from timings import from_microseconds, line_id
+
+# =================
+# = Configuration =
+# =================
+
+poll_interval = 1.0  # seconds between two polls of opc_data
+emit_distance = 0.5  # meters the material has to travel at current_position between two records
+max_history = synchsensordata.max_fetch_limit  # the maximum amount of speeds kept per line
+
+sink_path = "log/stream.jsonl"  # the JSON lines file the records are appended to
+sink_address = None  # the address of a local socket to send the records to instead (path or (host, port))
+record_directory = synchsensordata.record_directory  # a directory to write the records to as columnar shards instead
+
+
+def to_json(value):
+    """
+    Convert the values json can't serialize
+
+    :param value: the value
+    :return: the serializable value
+    """
+    if (isinstance(value, datetime.datetime)):
+        return str(value)
+    if (isinstance(value, (memoryview, array))):
+        return value.tolist()
+    if (isinstance(value, Mapping)):
+        return dict(value)
+    if (isinstance(value, Sequence)):
+        return list(value)
+    if (isinstance(value, decimal.Decimal)):
+        return float(value)
+    if (isinstance(value, (bytes, bytearray))):
+        return value.decode(errors='replace')
+    return str(value)
+
+
+class JsonLinesSink(object):
+    """
+    Appends every record as a line of json to a file
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def write(self, record):
+        self._file.write(json.dumps(record, default=to_json) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SocketSink(object):
+    """
+    Sends every record as a line of json to a local socket
+    """
+
+    def __init__(self, address):
+        """
+        :param address: the path of a unix socket or a tuple (host, port)
+        :type address: str|tuple[str, int]
+        """
+        if (isinstance(address, str)):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(address)
+
+    def write(self, record):
+        self._socket.sendall((json.dumps(record, default=to_json) + "\n").encode())
+
+    def close(self):
+        self._socket.close()
+
+
+def get_arrivals(profile, last_arrival):
+    """
+    Get the moments the material travelled emit_distance since the last arrival
+
+    :param profile: the speed profile of the line of current_position
+    :param last_arrival: the time of the last arrival in microseconds since epoch
+    :type profile: SpeedProfile
+    :type last_arrival: float
+
+    :raises IndexError: if the last arrival is older than the speed history
+
+    :return: the arrival times in microseconds since epoch
+    :rtype: list[float]
+    """
+    arrivals = []
+    distance = profile.distance_at(last_arrival) - emit_distance
+    while (distance >= 0):
+        arrivals.append(profile.time_at(distance))
+        distance -= emit_distance
+    return arrivals
+
+
+def stream(db, sink, polls=None, pool=None):
+    """
+    Emit the synchronized records of the material arriving at current_position
+
+    :param db: the database
+    :param sink: the sink the records are written to
+    :param polls: the amount of polls (None to run forever)
+    :param pool: the database connections to get the data of the sensors concurrently
+    :type db: Backend
+    :type sink: JsonLinesSink|SocketSink|ColumnarSink
+    :type polls: int
+    :type pool: ConnectionPool
+    """
+    histories = synchsensordata.create_speed_histories()
+    histories.fetch(db, synchsensordata.fetch_limit)
+
+    lengths = [f["length"] for f in synchsensordata.lines["lines"]]
+    profile = histories.profiles[line_id(synchsensordata.current_position, lengths)]
+    last_arrival = profile.times[0]
+
+    poll = 0
+    while (polls is None or poll < polls):
+        poll += 1
+        start = time.time()
+
+        if (histories.fetch_newer(db, max_history) > 0):
+            histories.truncate(max_history)
+            try:
+                arrivals = get_arrivals(profile, last_arrival)
+            except IndexError:
+                logging.warning("Lost track of the material, continuing with the newest speeds")
+                arrivals = []
+                last_arrival = profile.times[0]
+
+            if (len(arrivals) > 0):
+                moments = [from_microseconds(round(arrival)) for arrival in arrivals]
+                fetch_limit = synchsensordata.fetch_limit
+                try:
+                    records = synchsensordata.synchronize_batch(db, moments=moments, histories=histories, pool=pool)
+                except (IndexError, ValueError) as e:
+                    # not enough speed data for the moments (e.g. after a long stop of the belt)
+                    logging.error("Skipping %d records: %s", len(moments), e)
+                    synchsensordata.fetch_limit = fetch_limit
+                    records = []
+                for moment, record in zip(moments, records):
+                    sink.write({'time': moment, 'sensors': record})
+                logging.debug("Emitted %d records", len(records))
+                last_arrival = arrivals[-1]
+
+        time.sleep(max(0.0, poll_interval - (time.time() - start)))
+
+
+if (__name__ == "__main__"):
+    synchsensordata.init_logger()
+    logging.debug("Streaming started")
+
+    db = synchsensordata.connect_database()
+    if (db is not None):
+        if (sink_address is not None):
+            sink = SocketSink(sink_address)
+        elif (record_directory is not None):
+            sink = ColumnarSink(record_directory, synchsensordata.sensors)
+        else:
+            sink = JsonLinesSink(sink_path)
+        pool = None
+        if (synchsensordata.concurrent_retrieval):
+            pool = synchsensordata.create_connection_pool(db)
+        try:
+            stream(db, sink, pool=pool)
+        except KeyboardInterrupt:
+            logging.info("Streaming stopped")
+        finally:
+            metrics.export()
+            sink.close()
+            if (pool is not None):
+                pool.close()
+            else:
+                db.close()
@@ -0,0 +1,235 @@
+"""
+Server mode of the synchronizer
+
+Keeps the database connection, the speed histories and the file indexes warm and answers requests for
+the sensor data of the material at a position at a time over HTTP on localhost or a unix socket, so a
+request only costs the lookups instead of the startup.
+
+requests:
+GET /sync?time=<ISO datetime>&position=<meters>
+    time: the moment the material was at the position (multiple times for multiple records,
+          without time the material at the position at the time of the newest speed data)
+    position: the position in meters (default current_position, one for all times or one per time)
+GET /metrics
+    the collected metrics in the Prometheus text format
+
+structure of a response to /sync:
+{
+    'records': [{'time': the moment or null, 'position': the position, 'sensors': {sensor name: sensor data, ...}}, ...]
+}
+errors are answered with {'error': message}
+"""
+import datetime
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import metrics
+import synchsensordata
+
+from stream_sync import to_json
+
+# =================
+# = Configuration =
+# =================
+
+server_address = ("127.0.0.1", 8765)  # (host, port) for HTTP on localhost or the path of a unix socket
+refresh_interval = 1.0  # minimum seconds between two fetches of the newest speeds
+max_history = synchsensordata.max_fetch_limit  # the maximum amount of speeds kept per line
+
+
+class SyncState(object):
+    """
+    The warm state shared by all requests
+    """
+
+    def __init__(self, db, pool=None):
+        """
+        :param db: the database the speeds are fetched with if there is no pool (otherwise it is in the pool)
+        :param pool: the database connections the data of the sensors is retrieved with. Without a pool the
+            requests are answered one at a time, because a connection can't be shared between threads
+        :type db: database.Backend
+        :type pool: database.ConnectionPool
+        """
+        self.db = db
+        self.pool = pool
+        self.histories = synchsensordata.create_speed_histories()
+        self.last_refresh = 0.0
+        # the speed histories are not thread safe
+        self._lock = threading.Lock()
+        # the indexes of a file sensor are not thread safe, so the data of a file sensor is retrieved for one
+        # request at a time while the other sensors are retrieved for other requests
+        self._sensor_locks = dict((sensor['name'], threading.Lock()) for sensor in synchsensordata.sensors)
+
+    def warm_up(self):
+        """
+        Fetch the speeds and build the indexes of all sensors by synchronizing the material at current_position
+        """
+        with metrics.span("server.warm_up"):
+            self.synchronize([None], [synchsensordata.current_position])
+
+    def synchronize(self, moments, positions):
+        """
+        :param moments: the moments the material was at the positions (None for the time of the newest speed)
+        :param positions: the positions of the material
+        :type moments: list[datetime.datetime]
+        :type positions: list[float]
+
+        :raises IndexError: if there isn't enough speed data
+        :raises ValueError: if there isn't enough speed data within max_fetch_limit
+
+        :return: one record (sensor name -> sensor data) per moment
+        :rtype: list[dict]
+        """
+        # the connection of the database is in the pool, so the speeds are fetched with a connection of the pool
+        with self._lock, (self.pool.connection() if (self.pool is not None) else nullcontext(self.db)) as db:
+            if (time.time() - self.last_refresh >= refresh_interval):
+                if (len(self.histories.histories[0]) > 0 and self.histories.fetch_newer(db, max_history) > 0):
+                    self.histories.truncate(max_history)
+                self.last_refresh = time.time()
+
+            fetch_limit = synchsensordata.fetch_limit
+            try:
+                if (all(moment is None for moment in moments)):
+                    capture_times = synchsensordata.get_batch_capture_times(db, positions=positions,
+                                                                            histories=self.histories)
+                else:
+                    capture_times = synchsensordata.get_batch_capture_times(db, moments, positions, self.histories)
+            except ValueError:
+                # a request for moments before the history doesn't raise the limit of all following requests
+                synchsensordata.fetch_limit = fetch_limit
+                raise
+
+            if (self.pool is None):
+                return synchsensordata.get_batch_records(capture_times, self.db)
+        return synchsensordata.get_batch_records(capture_times, pool=self.pool, function=self.get_sensor_data)
+
+    def get_sensor_data(self, timestamps, sensor, db=None):
+        """
+        Get the data of a sensor for a request (see synchsensordata.get_sensor_data_batch)
+        """
+        if (sensor['data'] == 'database'):
+            # every request uses its own connection of the pool
+            return synchsensordata.get_sensor_data_batch(timestamps, sensor, db)
+        with self._sensor_locks[sensor['name']]:
+            return synchsensordata.get_sensor_data_batch(timestamps, sensor, db)
+
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests with the state of the server
+    """
+
+    def log_message(self, format, *args):
+        logging.debug("Request %s", format % args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=to_json).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if (url.path == "/metrics"):
+            data = metrics.to_prometheus(metrics.summary()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if (url.path != "/sync"):
+            self.send_json(404, {'error': "Unknown path %s" % url.path})
+            return
+
+        query = parse_qs(url.query)
+        try:
+            moments = [datetime.datetime.fromisoformat(value) for value in query.get('time', [])] or [None]
+            positions = [float(value) for value in query.get('position', [synchsensordata.current_position])]
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if (len(positions) == 1):
+            positions = positions * len(moments)
+        if (len(positions) != len(moments)):
+            self.send_json(400, {'error': "Expected one position or one position per time"})
+            return
+        belt_length = sum(line["length"] for line in synchsensordata.lines["lines"])
+        if (any(not 0 <= position <= belt_length for position in positions)):
+            self.send_json(400, {'error': "Expected positions between 0 and %s" % belt_length})
+            return
+
+        with metrics.span("server.request"):
+            try:
+                records = self.server.state.synchronize(moments, positions)
+            except (IndexError, ValueError) as e:
+                # not enough speed data for the moments
+                self.send_json(404, {'error': str(e)})
+                return
+        self.send_json(200, {'records': [{'time': moment, 'position': position, 'sensors': record}
+                                         for moment, position, record in zip(moments, positions, records)]})
+
+
+class SyncHTTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+# unix sockets are not available on windows
+if (hasattr(socketserver, "UnixStreamServer")):
+    class SyncUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_server(state, address=None):
+    """
+    :param state: the warm state to answer the requests with
+    :param address: (host, port) or the path of a unix socket (default server_address)
+    :type state: SyncState
+    :type address: tuple[str, int]|str
+
+    :return: the server, not serving yet
+    :rtype: socketserver.BaseServer
+    """
+    if (address is None):
+        address = server_address
+    if (isinstance(address, str)):
+        if (os.path.exists(address)):
+            os.remove(address)
+        server = SyncUnixHTTPServer(address, SyncRequestHandler)
+    else:
+        server = SyncHTTPServer(address, SyncRequestHandler)
+    server.state = state
+    return server
+
+
+if (__name__ == "__main__"):
+    synchsensordata.init_logger()
+    logging.debug("Server started")
+
+    db = synchsensordata.connect_database()
+    if (db is not None):
+        # the requests are answered concurrently, each with connections of the pool
+        pool = synchsensordata.create_connection_pool(db)
+        state = SyncState(db, pool)
+        state.warm_up()
+        server = create_server(state)
+        logging.info("Serving on %s", server_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Server stopped")
+        finally:
+            server.server_close()
+            metrics.export()
+            pool.close()
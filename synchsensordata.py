@@ -4,17 +4,36 @@ Betriebsmodus: Drehzahl -> Bandgeschwindigkeit
 3800 U/min -> 1.0 m/s
 
 """
+import bisect
 import csv
 import logging
+import math
 import os
 import time
 import mysql.connector
 
+import image_cache
+import metrics
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from os import listdir
 from os.path import isfile, join
 from mysql.connector import errorcode
-from mysql.connector.connection import MySQLConnection
 
+from analyser_blocks import get_data_size, open_data_file
+from analyser_chunks import ParsedFile, parse_range
+from analyser_image import AnalyserImage, locus_columns
+from analyser_index import datetime_format, get_index, parse_datetime, read_rows
+from analyser_manifest import get_manifest
+from analyser_store import get_store, store_lock
+from columnar_sink import ColumnarSink, to_float
+from database import ConnectionPool, LocalBackend, MysqlBackend, SqliteBackend
+from image_cache import get_image_cache
+from kinect_frames import load_closest_frames
+from kinect_index import get_kinect_index
+from speed_history import SpeedHistories
 from timings import *
 
 # =================
@@ -25,6 +44,12 @@ from timings import *
 file_root_path = "C:/Users/Leonhard.Gahr/Documents/KIPro/2018-05-24-14-15-36-14_daten/"
 current_position = 8.0
 
+# the source of the speeds and the database sensors (mysql|sqlite|local)
+# 'sqlite' reads a sqlite copy of the database, 'local' replays the tables exported as csv files from memory
+backend = "mysql"
+sqlite_path = file_root_path + "kipro.sqlite"
+local_data_path = file_root_path + "database/"  # contains <table name>.csv for opc_data and the sensor tables
+
 # mysql connection configuration
 mysql_config = {
     'user': 'root',
@@ -38,6 +63,25 @@ fetch_limit = 500
 fetch_limit_increase_rate = 500
 max_fetch_limit = 5000
 
+# interpolate the time offsets between the speeds instead of using the time of the speeds
+interpolate_time_offsets = False
+# consecutive speeds differing by at most this (in m/s) are merged into segments of constant speed if the time
+# offsets are interpolated (None to keep every speed)
+speed_tolerance = 0.0
+
+# the way images are looked up in the analyser files (index|store|fast_scan|scan)
+analyser_lookup = "index"
+
+# get the data of every sensor on its own thread, the database sensors share a pool of connections
+concurrent_retrieval = True
+connection_pool_size = 2
+
+# return the memory mapped kinect frames (see kinect_frames.py) instead of their file names
+load_kinect_frames = False
+
+# the directory the synchronized records are appended to as columnar shards (None to not keep them)
+record_directory = None
+
 # sensor configuration
 kinect = {
     "name": "Kinect",
@@ -122,61 +166,31 @@ lines = {
     "lines": [knickband, zufuehrband]
 }
 
-# structure templates
-img_template = {
-    'id': 0,
-    'datetime': datetime.datetime(1, 1, 1),
-    'locus_count': 0,
-    'loci': [],
-    'recipe': ''
-}
-
 
-def execute_query(connection, query):
-    """
-    Executes a single mysql query
-    :param connection:  the database to execute the query on
-    :param query: the actual query
-    :type connection: MySQLConnection
-    :type query: str
-
-    :return: the query result
-    :rtype: list[dict]
-    """
-    cursor = connection.cursor(dictionary=True)
-    cursor.execute(query)
-    result = cursor.fetchall()
-    cursor.close()
-    return result
-
-
-def get_speeds(connection):
+def get_speeds(db):
     """
     Get the speeds of the lines from the database
-    :param connection: the database
-    :type connection: MySQLConnection
+    :param db: the database
+    :type db: Backend
 
     :return: the list with the speeds
     :rtype: list[list[dict]]
     """
-    logging.info("Getting line speeds from database for %s" % ', '.join(map(str, [f['name'] for f in lines['lines']])))
-    v = []
-    for line in lines["lines"]:
-        query = "SELECT ITEM_VALUE as value, READ_TIME as time FROM `opc_data` " \
-                "WHERE `ITEM_NAME` = '%s' ORDER BY READ_TIME DESC LIMIT %d" % (
-                    lines["selector_template"],
-                    fetch_limit
-                )
-        query = query % {'line_name': line["database_name"], 'value_name': 'Istwert_Drehzahl'}
-        result = execute_query(connection, query)
+    logging.info("Getting line speeds from database for %s", ', '.join(map(str, [f['name'] for f in lines['lines']])))
+    requests = [(lines["selector_template"] % {'line_name': line["database_name"], 'value_name': 'Istwert_Drehzahl'},
+                 fetch_limit, None) for line in lines["lines"]]
 
-        logging.debug("Executed query \"%s\" and got %d results" % (query, len(result)))
+    with metrics.span("database.fetch_speeds"):
+        speeds = db.fetch_speeds(requests, False)
+    metrics.count("database.rows", sum(len(times) for times, _ in speeds))
 
+    v = []
+    for line, (times, values) in zip(lines["lines"], speeds):
         current_v = []
-        for row in result:
+        for read_time, value in zip(times, values):
             current_v.append(
-                {'datetime': row["time"],
-                 'speed': float(row["value"]) * line['speed_factor']})
+                {'datetime': from_microseconds(read_time),
+                 'speed': value * line['speed_factor']})
         v.append(current_v)
 
     return v
@@ -215,32 +229,290 @@ def reformat_analyser(sensor_analyser):
             os.rename(f, new_file)
 
 
-def get_locus_from_row(row):
+def get_image_from_rows(rows):
     """
-    Get a locus from a row of the csv file
+    Create an image from the rows of the csv file belonging to it
 
-    :param row: the row
-    :return: the locus as dictionary with the following structure:
-        {
-            'number': int,
-            'classification': int,
-            'color_r': int,
-            'color_g': int,
-            'color_b': int,
-            'height': int,
-            'spectra': list[float]
-        }
+    :param rows: the rows of the image
+    :type rows: list[list[str]]
+
+    :return: the image (see access_csv_data)
+    :rtype: AnalyserImage
     """
-    locus = {
-        'number': int(row[2]),
-        'classification': int(row[261]),
-        'color_r': int(row[262]),
-        'color_g': int(row[263]),
-        'color_b': int(row[264]),
-        'height': int(row[265]),
-        'spectra': row[5:240]
-    }
-    return locus
+    img = AnalyserImage(int(rows[0][0]), parse_datetime(rows[0][1]), int(rows[0][3]), rows[0][266])
+    for row in rows:
+        img.append_row(row)
+    return img
+
+
+def access_indexed_csv_data(path, timestamp, following_path):
+    """
+    Read the data for a specific time from a csv file by seeking to the closest image with the help of
+    the byte offset index of the file
+
+    :param path: The path of the file the data should be located in
+    :param timestamp: The timestamp of the data to be accessed
+    :param following_path: The path of the following file in case the dataset is incomplete in the actual file
+    :type path: str
+    :type timestamp: datetime.datetime
+    :type following_path: str
+
+    :return: the image (see access_csv_data) or None if the file contains no images
+    :rtype: AnalyserImage
+    """
+    index = get_index(path)
+    i = index.find_closest(timestamp)
+    if (i is None):
+        logging.error("There are no images in %s", path)
+        return
+
+    cache = get_image_cache()
+    key = (path, index.ids[i], parse_datetime(index.datetimes[i]))
+    img = cache.get(key)
+    if (img is not None):
+        return img
+
+    img = read_indexed_images(path, index, i)
+
+    # check if the image is incomplete. Can happen if an image is written over two files
+    if (not index.is_complete(i)):
+        if (following_path is None or i != len(index) - 1):
+            logging.error("Image #%d incomplete. Returning anyways", img.id)
+        else:
+            logging.debug("Image #%d incomplete, trying to complete with %s", img.id, following_path)
+            following_index = get_index(following_path)
+            if (len(following_index) > 0 and following_index.datetimes[0] == index.datetimes[i]):
+                for row in read_rows(following_path, following_index.offsets[0], following_index.rows[0]):
+                    img.append_row(row)
+            if (img.is_complete()):
+                logging.debug("Image #%d completed", img.id)
+            else:
+                logging.error("Image #%d still incomplete. Returning anyways", img.id)
+            if (img.is_complete()):
+                cache.put(key, img)
+    return img
+
+
+def read_indexed_images(path, index, i):
+    """
+    Parse an image and the images around it that aren't cached yet (see image_cache.window) with a single read
+    and cache the complete ones
+
+    :param path: the path of the csv file
+    :param index: the index of the file
+    :param i: the position of the image in the index
+    :type path: str
+    :type index: AnalyserIndex
+    :type i: int
+
+    :return: the image at the position
+    :rtype: AnalyserImage
+    """
+    cache = get_image_cache()
+
+    def is_cached(j):
+        return (path, index.ids[j], parse_datetime(index.datetimes[j])) in cache
+
+    first = i
+    while (first > 0 and i - first < image_cache.window and not is_cached(first - 1)):
+        first -= 1
+    last = i
+    while (last < len(index) - 1 and last - i < image_cache.window and not is_cached(last + 1)):
+        last += 1
+
+    rows = read_rows(path, index.offsets[first], sum(index.rows[first:last + 1]))
+    start = 0
+    for j in range(first, last + 1):
+        image = get_image_from_rows(rows[start:start + index.rows[j]])
+        start += index.rows[j]
+        if (index.is_complete(j)):
+            cache.put((path, image.id, image.datetime), image)
+        if (j == i):
+            img = image
+    return img
+
+
+def access_stored_csv_data(path, timestamp, following_path):
+    """
+    Read the data for a specific time from the memory mapped binary store of a csv file.
+    The file is converted into the store on the first access
+
+    :param path: The path of the file the data should be located in
+    :param timestamp: The timestamp of the data to be accessed
+    :param following_path: The path of the following file in case the dataset is incomplete in the actual file
+    :type path: str
+    :type timestamp: datetime.datetime
+    :type following_path: str
+
+    :return: the image (see access_csv_data) or None if the file contains no images
+    :rtype: AnalyserImage
+    """
+    # the stores are only replaced while no lookup reads them
+    with store_lock:
+        store = get_store(path)
+        if (store is None):
+            # the file is still written, so its store can't be kept up to date
+            return access_indexed_csv_data(path, timestamp, following_path)
+        i = store.find_closest(timestamp)
+        if (i is None):
+            logging.error("There are no images in %s", path)
+            return
+
+        cache = get_image_cache()
+        key = (path, store.ids[i], from_microseconds(store.datetimes[i]))
+        img = cache.get(key)
+        if (img is not None):
+            return img
+
+        img = store.get_image(i)
+
+        # check if the image is incomplete. Can happen if an image is written over two files
+        if (not store.is_complete(i)):
+            if (following_path is None or i != len(store) - 1):
+                logging.error("Image #%d incomplete. Returning anyways", img.id)
+            else:
+                logging.debug("Image #%d incomplete, trying to complete with %s", img.id, following_path)
+                following_store = get_store(following_path)
+                if (following_store is not None and len(following_store) > 0 and
+                        following_store.datetimes[0] == store.datetimes[i]):
+                    img.extend(following_store.get_image(0))
+                if (img.is_complete()):
+                    logging.debug("Image #%d completed", img.id)
+                else:
+                    logging.error("Image #%d still incomplete. Returning anyways", img.id)
+        if (img.is_complete()):
+            cache.put(key, img)
+        return img
+
+
+def iterate_raw_images(csv_file):
+    """
+    Iterate the images of a csv file without parsing the rows. The rows of an image are identified by
+    the id and datetime prefix of its first row and counted with its locus count
+
+    :param csv_file: the opened csv file
+    :type csv_file: io.TextIOWrapper
+
+    :return: generator of tuples (datetime string, locus count, raw rows)
+    :rtype: collections.Iterable[tuple[str, int, list[str]]]
+    """
+    line = next(csv_file, None)
+    while (line is not None):
+        fields = line.split(';', 4)
+        if (len(fields) < 5):
+            line = next(csv_file, None)
+            continue
+
+        prefix = "%s;%s;" % (fields[0], fields[1])
+        locus_count = int(fields[3])
+        lines = [line]
+        line = next(csv_file, None)
+        while (line is not None and len(lines) < locus_count and line.startswith(prefix)):
+            lines.append(line)
+            line = next(csv_file, None)
+        yield fields[1], locus_count, lines
+
+
+def fast_scan_csv_data(path, timestamp, following_path):
+    """
+    Read the data for a specific time from a csv file by comparing the raw timestamps of the images.
+    Only the rows of the chosen image are parsed
+
+    :param path: The path of the file the data should be located in
+    :param timestamp: The timestamp of the data to be accessed
+    :param following_path: The path of the following file in case the dataset is incomplete in the actual file
+    :type path: str
+    :type timestamp: datetime.datetime
+    :type following_path: str
+
+    :return: the image (see access_csv_data) or None if the file contains no images
+    :rtype: AnalyserImage
+    """
+    return sweep_csv_data(path, [timestamp], following_path)[0]
+
+
+def sweep_csv_data(path, timestamps, following_path):
+    """
+    Read the data for multiple timestamps in a single pass over a csv file by comparing the raw timestamps
+    of the images. Only the rows of the chosen images are parsed
+
+    :param path: The path of the file the data should be located in
+    :param timestamps: The sorted timestamps of the data to be accessed
+    :param following_path: The path of the following file in case the dataset is incomplete in the actual file
+    :type path: str
+    :type timestamps: list[datetime.datetime]
+    :type following_path: str
+
+    :return: the images closest to the timestamps (see access_csv_data). None if the file contains no images
+    :rtype: list[AnalyserImage]
+    """
+    with open_data_file(path, "r", newline='') as csv_file:
+        images = iterate_raw_images(csv_file)
+        image = next(images, None)
+        if (image is None):
+            logging.error("There are no images in %s", path)
+            return [None] * len(timestamps)
+
+        # the raw timestamps can only be compared if they are zero padded
+        datetime_string = image[0]
+        if (len(datetime_string) < 20 or datetime_string[4] != '-' or datetime_string[7] != '-' or
+                datetime_string[10] != ' ' or datetime_string[13] != ':'):
+            logging.debug("Timestamps in %s have no fixed format, scanning the whole file", path)
+            return [scan_csv_data(path, timestamp, following_path) for timestamp in timestamps]
+
+        chosen_images = []
+        previous_image = None
+        for timestamp in timestamps:
+            target = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+            while (image is not None):
+                datetime_string, locus_count, lines = image
+                if (len(lines) == locus_count and datetime_string > target):
+                    break
+                previous_image = image
+                image = next(images, None)
+
+            # check if the current image or the previous image is closer to the timestamp
+            if (image is None):
+                chosen_images.append(previous_image)
+            elif (previous_image is not None and
+                  timestamp - datetime.datetime.strptime(previous_image[0], "%Y-%m-%d %H:%M:%S.%f") <
+                  datetime.datetime.strptime(image[0], "%Y-%m-%d %H:%M:%S.%f") - timestamp):
+                chosen_images.append(previous_image)
+            else:
+                chosen_images.append(image)
+
+    # parse every chosen image only once
+    cache = get_image_cache()
+    imgs = {}
+    for datetime_string, locus_count, lines in chosen_images:
+        if (lines[0] in imgs):
+            continue
+        key = (path, int(lines[0].split(';', 1)[0]), parse_datetime(datetime_string))
+        img = cache.get(key)
+        if (img is not None):
+            imgs[lines[0]] = img
+            continue
+        img = get_image_from_rows(list(csv.reader(lines, delimiter=';')))
+
+        # check if the image is incomplete. Can happen if an image is written over two files
+        if (len(lines) != locus_count):
+            if (following_path is None):
+                logging.error("Image #%d incomplete. Returning anyways", img.id)
+            else:
+                logging.debug("Image #%d incomplete, trying to complete with %s", img.id, following_path)
+                with open_data_file(following_path, "r", newline='') as next_csv_file:
+                    for row in csv.reader(next_csv_file, delimiter=';'):
+                        if (row[1] != datetime_string):
+                            break
+                        img.append_row(row)
+                if (img.is_complete()):
+                    logging.debug("Image #%d completed", img.id)
+                else:
+                    logging.error("Image #%d still incomplete. Returning anyways", img.id)
+        if (img.is_complete()):
+            cache.put(key, img)
+        imgs[lines[0]] = img
+    return [imgs[image[2][0]] for image in chosen_images]
 
 
 def access_csv_data(path, timestamp, following_path):
@@ -255,12 +527,12 @@ def access_csv_data(path, timestamp, following_path):
     :type timestamp: datetime.datetime
     :type following_path: str
 
-    :return: A dictionary with the following structure:
+    :return: The image (see analyser_image.py). It can be read like a dictionary with the following structure:
         {
             'id': int,
             'datetime': datetime.datetime,
             'locus_count': int,
-            'loci': list[
+            'loci': sequence[
                     {
                         'number': int,
                         'classification': int,
@@ -268,119 +540,250 @@ def access_csv_data(path, timestamp, following_path):
                         'color_g': int,
                         'color_b': int,
                         'height': int,
-                        'spectra': list[float]
+                        'spectra': array('f')
                     }
                 ],
             'recipe': str
         }
+    :rtype: AnalyserImage
     """
-    with open(path, "r") as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=';')
-        # initialize img to probably avoid key errors
-        img = img_template
+    if (analyser_lookup == 'index'):
+        return access_indexed_csv_data(path, timestamp, following_path)
+    if (analyser_lookup == 'store'):
+        return access_stored_csv_data(path, timestamp, following_path)
+    if (analyser_lookup == 'fast_scan'):
+        return fast_scan_csv_data(path, timestamp, following_path)
+    return scan_csv_data(path, timestamp, following_path)
 
+
+def scan_csv_data(path, timestamp, following_path):
+    """
+    Read the data for a specific time from a csv file by parsing every row until the timestamp is passed
+    (see access_csv_data)
+
+    :param path: The path of the file the data should be located in
+    :param timestamp: The timestamp of the data to be accessed
+    :param following_path: The path of the following file in case the dataset is incomplete in the actual file
+    :type path: str
+    :type timestamp: datetime.datetime
+    :type following_path: str
+
+    :return: the image (see access_csv_data) or None if the file contains no images
+    :rtype: AnalyserImage
+    """
+    with open_data_file(path, "r") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=';')
+        img = None
         previous_img = None
 
         for row in csv_reader:
             row_datetime = datetime.datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S.%f")
             # add the row to the current image, if it's still part of it, otherwise create a new one
-            if (img['id'] == int(row[0]) and img['datetime'] == row_datetime):
-                img['loci'].append(get_locus_from_row(row))
+            if (img is not None and img.id == int(row[0]) and img.datetime == row_datetime):
+                img.append_row(row)
             else:
                 previous_img = img
-
-                # initialize the image
-                img = {'id': int(row[0]),
-                       'datetime': row_datetime,
-                       'locus_count': int(row[3]),
-                       'recipe': row[266],
-                       'loci': [get_locus_from_row(row), ]}
+                img = AnalyserImage(int(row[0]), row_datetime, int(row[3]), row[266])
+                img.append_row(row)
 
             # check if the image is complete
-            if (len(img['loci']) == img['locus_count']):
+            if (img.is_complete()):
 
                 # check if the current image or the previous image is closer to the timestamp
-                if (img['datetime'] > timestamp):
+                if (img.datetime > timestamp):
                     if (previous_img is not None):
-                        current_img_datetime = img['datetime']
-                        previous_img_datetime = previous_img['datetime']
-                        if (timestamp - previous_img_datetime < current_img_datetime - timestamp):
+                        if (timestamp - previous_img.datetime < img.datetime - timestamp):
                             img = previous_img
                     break
 
+        if (img is None):
+            logging.error("There are no images in %s", path)
+            return
+
         # check if the image is incomplete. Can happen if an image is written over two files
-        if (len(img['loci']) != img['locus_count']):
+        if (not img.is_complete()):
             if (following_path is None):
-                logging.error("Image #%d incomplete. Returning anyways" % img['id'])
+                logging.error("Image #%d incomplete. Returning anyways", img.id)
             else:
-                logging.debug("Image #%d incomplete, trying to complete with %s" % (img['id'], following_path))
-                with open(following_path, "r") as next_csv_file:
+                logging.debug("Image #%d incomplete, trying to complete with %s", img.id, following_path)
+                with open_data_file(following_path, "r") as next_csv_file:
                     next_csv_reader = csv.reader(next_csv_file, delimiter=';')
                     for row in next_csv_reader:
                         current_img = datetime.datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S.%f")
-                        if (current_img == img['datetime']):
-                            img['loci'].append(get_locus_from_row(row))
+                        if (current_img == img.datetime):
+                            img.append_row(row)
                         else:
                             break
-                    if (len(img['loci']) == img['locus_count']):
-                        logging.debug("Image #%d completed")
+                    if (img.is_complete()):
+                        logging.debug("Image #%d completed", img.id)
                     else:
-                        logging.error("Image #%d still incomplete. Returning anyways")
+                        logging.error("Image #%d still incomplete. Returning anyways", img.id)
         return img
 
 
 def get_sensor_data_from_csv(timestamp, sensor):
-    # TODO optimize like kinect
-
-    file_times = []
-    for file in os.listdir(sensor['location']):
-        if (isfile(join(sensor['location'], file)) and
-                file.startswith(sensor['file_templates'][0].split("%", 1)[0])):
-            datetime_string = file[len(sensor['file_templates'][0].split("%", 1)[0]):-len(
-                file.split(".")[-1]) - 1]
-            file_times.append(datetime.datetime.strptime(datetime_string, "%Y-%m-%d_%H-%M-%S.%f"))
-
-    target_file_time = None
-    next_file_time = None
-    for e in range(0, len(file_times)):
-        if (file_times[e] < timestamp):
-            target_file_time = file_times[e]
-            if (len(file_times) - 1 != e):
-                next_file_time = file_times[e + 1]
-            else:
-                next_file_time = None
+    """
+    Get the analyser image closest to a timestamp
 
-    if (target_file_time is None):
-        logging.error("There are no records for %s in %s" % (timestamp, sensor['location']))
+    :param timestamp: the timestamp
+    :param sensor: the analyser sensor dictionary
+    :type timestamp: datetime.datetime
+    :type sensor: dict
+
+    :return: the image (see access_csv_data) or None if there are no records for the timestamp
+    :rtype: dict
+    """
+    manifest = get_manifest(sensor['location'])
+    i = manifest.find(timestamp)
+    if (i is None):
+        logging.error("There are no records for %s in %s", timestamp, sensor['location'])
         return
 
-    string_settings = {
-        'year': target_file_time.year,
-        'month': target_file_time.month,
-        'day': target_file_time.day,
-        'hour': target_file_time.hour,
-        'minute': target_file_time.minute,
-        'second': target_file_time.second,
-        'millisecond': int(target_file_time.microsecond / 1000)
-    }
+    following_path = None
+    if (i + 1 < len(manifest)):
+        following_path = manifest.get_path(i + 1)
 
-    next_datetime_file = None
-    if (next_file_time is not None):
-        next_date_settings = {
-            'year': next_file_time.year,
-            'month': next_file_time.month,
-            'day': next_file_time.day,
-            'hour': next_file_time.hour,
-            'minute': next_file_time.minute,
-            'second': next_file_time.second,
-            'millisecond': int(next_file_time.microsecond / 1000)
-        }
+    with metrics.span("analyser.access"):
+        return access_csv_data(manifest.get_path(i), timestamp, following_path)
+
+
+def get_sensor_data_from_csv_batch(timestamps, sensor):
+    """
+    Get the analyser images closest to multiple timestamps. Every file is opened only once
+
+    :param timestamps: the sorted timestamps
+    :param sensor: the analyser sensor dictionary
+    :type timestamps: list[datetime.datetime]
+    :type sensor: dict
+
+    :return: the image closest to every timestamp (see access_csv_data)
+    :rtype: list[dict]
+    """
+    manifest = get_manifest(sensor['location'])
+
+    sensor_data = []
+    for i, group in groupby(timestamps, key=manifest.find):
+        group = list(group)
+        if (i is None):
+            logging.error("There are no records for %s in %s", group[0], sensor['location'])
+            sensor_data += [None] * len(group)
+            continue
+
+        following_path = None
+        if (i + 1 < len(manifest)):
+            following_path = manifest.get_path(i + 1)
+
+        with metrics.span("analyser.access"):
+            if (analyser_lookup in ('fast_scan', 'scan')):
+                sensor_data += sweep_csv_data(manifest.get_path(i), group, following_path)
+            else:
+                sensor_data += [access_csv_data(manifest.get_path(i), timestamp, following_path)
+                                for timestamp in group]
+    return sensor_data
 
-        next_datetime_file = join(sensor['location'], sensor['file_templates'][0] % next_date_settings)
 
-    return access_csv_data(join(sensor['location'], sensor['file_templates'][0] % string_settings),
-                           timestamp,
-                           next_datetime_file)
+def get_database_value(sensor, row):
+    """
+    :param sensor: the database sensor dictionary
+    :param row: the row closest to the requested time
+    :type sensor: dict
+    :type row: dict
+
+    :return: the data of the sensor in the row
+    """
+    if ('field_no' in sensor['location']):
+        return dict(list(row.items())[sensor['location']['field_no']['start']:sensor['location']['field_no']['end']])
+    return list(row.items())[0][1]
+
+
+def get_sensor_data_from_database_batch(timestamps, sensor, db):
+    """
+    Get the rows closest to multiple timestamps with a single query
+
+    :param timestamps: the sorted timestamps
+    :param sensor: the database sensor dictionary
+    :param db: the database
+    :type timestamps: list[datetime.datetime]
+    :type sensor: dict
+    :type db: Backend
+
+    :return: the sensor data for every timestamp (see get_sensor_data)
+    :rtype: list
+    """
+    if ('datediff' not in sensor['condition']):
+        logging.critical("Database sensor '%s' has no datediff condition", sensor['name'])
+        raise ValueError("Database sensor '%s' has no datediff condition" % sensor['name'])
+
+    # all rows from the last one before the first timestamp to the end of the search window of the last one
+    with metrics.span("database.get_sensor_rows"):
+        rows = db.get_sensor_rows(sensor, timestamps[0],
+                                  timestamps[-1] + datetime.timedelta(0, 2, -timestamps[-1].microsecond))
+    metrics.count("database.rows", len(rows))
+    row_times = [list(row.values())[1] for row in rows]
+
+    sensor_data = []
+    for timestamp in timestamps:
+        i = bisect.bisect_right(row_times, timestamp)
+        if (i == 0):
+            sensor_data.append([])
+            continue
+
+        row = rows[i - 1]
+        date_limit = timestamp + datetime.timedelta(0, 2, -timestamp.microsecond)
+        if (i < len(rows) and row_times[i] < date_limit and
+                abs(timestamp - row_times[i]).total_seconds() < abs(row_times[i - 1] - timestamp).total_seconds()):
+            row = rows[i]
+        sensor_data.append(get_database_value(sensor, row))
+    return sensor_data
+
+
+def get_sensor_data_batch(timestamps, sensor, db=None):
+    """
+    Get the sensor data closest to multiple timestamps with a single pass over the data of the sensor
+
+    :param timestamps: The times the data should be accessed (None if there is no data for a time)
+    :param sensor: The sensor to get the data from
+    :param db: If necessary a database the sensordata is saved in
+    :type timestamps: list[datetime.datetime]
+    :type sensor: dict
+    :type db: Backend
+
+    :return: sensor data for every timestamp (see get_sensor_data)
+    :rtype: list
+    """
+    logging.info("Getting data from sensor '%s' at %d times", sensor['name'], len(timestamps))
+    with metrics.span("sensor." + sensor['name']) as sensor_span:
+        order = sorted([i for i in range(len(timestamps)) if timestamps[i] is not None], key=lambda i: timestamps[i])
+        sorted_timestamps = [timestamps[i] for i in order]
+
+        if (len(sorted_timestamps) == 0):
+            sorted_data = []
+        elif (sensor['data'] == 'file' and sensor['specification'] == 'csv'):
+            sorted_data = get_sensor_data_from_csv_batch(sorted_timestamps, sensor)
+        elif (sensor['data'] == 'file' and sensor['specification'] == 'image'):
+            index = get_kinect_index(sensor)
+            sorted_data = []
+            for timestamp in sorted_timestamps:
+                if (load_kinect_frames):
+                    closest_files = load_closest_frames(sensor, index, timestamp)
+                else:
+                    closest_files = [index.find_closest(file_prefix, timestamp)
+                                     for file_prefix in sensor["file_prefixes"]]
+                if (len(closest_files) == 1):
+                    sorted_data.append(closest_files[0])
+                else:
+                    sorted_data.append(closest_files)
+        elif (sensor['data'] == 'database'):
+            sorted_data = get_sensor_data_from_database_batch(sorted_timestamps, sensor, db)
+        else:
+            logging.critical("Unknown sensor data type %s", sensor['data'])
+            raise ValueError("Unknown sensor data type %s" % sensor['data'])
+
+        sensor_data = [None] * len(timestamps)
+        for i, data in zip(order, sorted_data):
+            sensor_data[i] = data
+    logging.info("Got data for sensor '%s' in %s seconds", sensor['name'], sensor_span.seconds)
+    return sensor_data
 
 
 def get_sensor_data(timestamp, sensor, db=None):
@@ -391,85 +794,397 @@ def get_sensor_data(timestamp, sensor, db=None):
     :param db: If necessary a database the sensordata is saved in
     :type timestamp: datetime.datetime
     :type sensor: dict
-    :type db: MySQLConnection
+    :type db: Backend
 
     :return: sensor data
     :rtype: list
     """
-    logging.info("Getting data from sensor '%s' at %s" % (sensor['name'], str(timestamp)))
-    start = time.time()
+    logging.info("Getting data from sensor '%s' at %s", sensor['name'], timestamp)
+    with metrics.span("sensor." + sensor['name']) as sensor_span:
+        sensor_data = []
+        if (sensor['data'] == 'file'):
+            if (sensor['specification'] == 'csv'):
+                sensor_data.append(get_sensor_data_from_csv(timestamp, sensor))
+            elif (sensor['specification'] == 'image'):
+                # the frames of every prefix sorted by date of modification
+                index = get_kinect_index(sensor)
+                if (load_kinect_frames):
+                    sensor_data += load_closest_frames(sensor, index, timestamp)
+                else:
+                    for file_prefix in sensor["file_prefixes"]:
+                        sensor_data.append(index.find_closest(file_prefix, timestamp))
+
+        elif (sensor['data'] == 'database'):
+            sensor_data.append(get_sensor_data_from_database_batch([timestamp], sensor, db)[0])
 
-    sensor_data = []
-    if (sensor['data'] == 'file'):
-        if (sensor['specification'] == 'csv'):
-            sensor_data.append(get_sensor_data_from_csv(timestamp, sensor))
-        elif (sensor['specification'] == 'image'):
-            os.chdir(sensor['location'])
-            files = os.listdir(sensor['location'])
-            # sort all files by date of creation
-            files.sort(key=lambda x: os.path.getmtime(x))
-
-            # split the prefixes of the files
-            for file_prefix in sensor["file_prefixes"]:
-                filtered = list(filter(lambda f: f.startswith(file_prefix), files))
-                closest_file_time = min(filtered, key=lambda d: abs(
-                    datetime.datetime.fromtimestamp(os.path.getmtime(d)) - timestamp))
-
-                sensor_data.append(closest_file_time)
-
-    elif (sensor['data'] == 'database'):
-        query = "SELECT "
-        if ('field_name' in sensor['location']):
-            query += "%s" % sensor['location']['field_name']
-            if ('datediff' in sensor['condition']):
-                query += ", %s " % sensor['condition']['datediff']['field_name']
         else:
-            query += "* "
+            logging.critical("Unknown sensor data type %s", sensor['data'])
+            raise ValueError("Unknown sensor data type %s" % sensor['data'])
+    logging.info("Got data for sensor '%s' in %s seconds", sensor['name'], sensor_span.seconds)
 
-        query += "FROM %s " % sensor['specification']
+    if len(sensor_data) == 1:
+        return sensor_data[0]
+    else:
+        return sensor_data
 
-        if ('field' in sensor['condition']):
-            query += "WHERE %s = %a " % (
-                sensor['condition']['field']['field_name'], sensor['condition']['field']['value'])
 
-        if ('datediff' in sensor['condition']):
-            if ("WHERE" in query):
-                query += "AND "
-            else:
-                query += "WHERE "
-            date_field = sensor['condition']['datediff']['field_name']
-            date_val = timestamp + datetime.timedelta(0, 2, -timestamp.microsecond)
-            query += "%s < '%s' ORDER BY %s DESC" % (date_field, date_val, date_field)
-
-        query += " LIMIT 10"
-
-        previous = None
-        logging.debug("Execute query %a" % query)
-        for row in execute_query(db, query):
-            row_time = list(row.values())[1]
-            if (row_time <= timestamp):
-                if (previous is not None and abs(timestamp - list(previous.values())[1]).total_seconds() < abs(
-                        row_time - timestamp).total_seconds()):
-                    row = previous
-
-                if ('field_no' in sensor['location']):
-                    sensor_data.append(
-                        dict(list(row.items())[
-                             sensor['location']['field_no']['start']:sensor['location']['field_no']['end']]))
+def get_sensor_data_range_from_csv(sensor, start, end):
+    """
+    Read all analyser images captured within a time window. The rows of the window are read sequentially
+    from every file once (see analyser_index.py)
+
+    :param sensor: the analyser sensor dictionary
+    :param start: the start of the time window
+    :param end: the end of the time window (exclusive)
+    :type sensor: dict
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+
+    :return: the images (see get_sensor_data_range)
+    :rtype: dict
+    """
+    manifest = get_manifest(sensor['location'])
+    start_string = start.strftime(datetime_format)
+    end_string = end.strftime(datetime_format)
+
+    images = ParsedFile()
+    for entry in manifest.entries:
+        if (entry.first >= end or entry.last < start):
+            continue
+        path = join(sensor['location'], entry.name)
+        index = get_index(path)
+        first = bisect.bisect_left(index.datetimes, start_string)
+        last = bisect.bisect_left(index.datetimes, end_string)
+        if (first == last):
+            continue
+
+        end_offset = index.offsets[last] if (last < len(index)) else get_data_size(path)
+        parsed = parse_range(path, index.offsets[first], end_offset)
+        metrics.count("analyser.rows_read", sum(parsed.rows))
+        if (len(images) > 0 and len(parsed) > 0 and images.ids[-1] == parsed.ids[0] and
+                images.datetimes[-1] == parsed.datetimes[0]):
+            # the rest of an image written over two files. Its loci directly follow the loci read before
+            images.rows[-1] += parsed.rows[0]
+            for name in ('ids', 'datetimes', 'offsets', 'rows', 'locus_counts', 'recipes'):
+                del getattr(parsed, name)[0]
+        images.extend(parsed)
+
+    loci = array('q', [0])
+    for rows in images.rows:
+        loci.append(loci[-1] + rows)
+    data = {'id': images.ids, 'datetime': images.datetimes, 'locus_count': images.locus_counts,
+            'recipe': images.recipes, 'loci': loci, 'spectra': images.spectra}
+    data.update(zip(locus_columns, images.columns))
+    return data
+
+
+def get_sensor_data_range_from_images(sensor, start, end):
+    """
+    Find all frames of a kinect sensor modified within a time window
+
+    :param sensor: the kinect sensor dictionary
+    :param start: the start of the time window
+    :param end: the end of the time window (exclusive)
+    :type sensor: dict
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+
+    :return: the frames (see get_sensor_data_range)
+    :rtype: dict
+    """
+    index = get_kinect_index(sensor)
+    data = {}
+    for file_prefix in sensor['file_prefixes']:
+        times = index.times[file_prefix]
+        # the mtimes are compared in local time like the naive window, but returned like the times of the other
+        # sensors (naive datetimes taken as UTC), so the columns of all sensors can be compared
+        first = bisect.bisect_left(times, start.timestamp())
+        last = bisect.bisect_left(times, end.timestamp())
+        data[file_prefix + ".time"] = array('q', (to_microseconds(datetime.datetime.fromtimestamp(mtime))
+                                                   for mtime in times[first:last]))
+        data[file_prefix] = index.names[file_prefix][first:last]
+    return data
+
+
+def get_sensor_data_range_from_database(sensor, start, end, db):
+    """
+    Get all rows of a database sensor within a time window with a single query
+
+    :param sensor: the database sensor dictionary
+    :param start: the start of the time window
+    :param end: the end of the time window (exclusive)
+    :param db: the database
+    :type sensor: dict
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :type db: Backend
+
+    :return: the rows (see get_sensor_data_range)
+    :rtype: dict
+    """
+    if ('datediff' not in sensor['condition']):
+        logging.critical("Database sensor '%s' has no datediff condition", sensor['name'])
+        raise ValueError("Database sensor '%s' has no datediff condition" % sensor['name'])
+
+    with metrics.span("database.get_sensor_rows"):
+        rows = db.get_sensor_rows(sensor, start, end)
+    metrics.count("database.rows", len(rows))
+
+    data = {'time': array('q')}
+    for row in rows:
+        row_time = list(row.values())[1]
+        # the rows start with the last one at or before the start
+        if (row_time < start):
+            continue
+        data['time'].append(to_microseconds(row_time))
+        value = get_database_value(sensor, row)
+        fields = value if (isinstance(value, dict)) else {'value': value}
+        for field_name, field_value in fields.items():
+            if (field_name not in data):
+                # fields missing in the rows before
+                data[field_name] = array('d', [math.nan] * (len(data['time']) - 1))
+            data[field_name].append(to_float(field_value))
+        # fields missing in this row
+        for column in data.values():
+            if (len(column) < len(data['time'])):
+                column.append(math.nan)
+    return data
+
+
+def get_sensor_data_range(sensor, start, end, db=None):
+    """
+    Get all data of a sensor within a time window as columns, e.g. to analyse a whole segment of the belt
+    instead of querying every moment
+
+    :param sensor: The sensor to get the data from
+    :param start: The start of the time window
+    :param end: The end of the time window (exclusive)
+    :param db: If necessary a database the sensordata is saved in
+    :type sensor: dict
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :type db: Backend
+
+    :return: column name -> column (every column has one value per record unless stated otherwise)
+        analyser sensors (n images, m loci, see analyser_image.py):
+            'id', 'datetime' (microseconds since epoch), 'locus_count': array('q')
+            'recipe': list[str]
+            'loci': the first locus of every image in the locus columns, array('q') with n + 1 values
+            'number', 'classification', 'color_r', 'color_g', 'color_b', 'height': array('i') with m values
+            'spectra': array('f') with m * spectra_count values
+        kinect sensors (for every file prefix):
+            '<file prefix>.time': the modification time of the frames in microseconds since epoch (the local
+                time taken as UTC like the other sensors), array('q')
+            '<file prefix>': the file names of the frames, list[str]
+        database sensors:
+            'time': the time of the rows in microseconds since epoch, array('q')
+            '<field name>': the fields of a sensor with multiple fields or 'value' for a sensor with a single
+                field, array('d') (nan if missing or not numeric)
+    :rtype: dict
+    """
+    logging.info("Getting data from sensor '%s' from %s to %s", sensor['name'], start, end)
+    with metrics.span("sensor_range." + sensor['name']) as sensor_span:
+        if (sensor['data'] == 'file' and sensor['specification'] == 'csv'):
+            data = get_sensor_data_range_from_csv(sensor, start, end)
+        elif (sensor['data'] == 'file' and sensor['specification'] == 'image'):
+            data = get_sensor_data_range_from_images(sensor, start, end)
+        elif (sensor['data'] == 'database'):
+            data = get_sensor_data_range_from_database(sensor, start, end, db)
+        else:
+            logging.critical("Unknown sensor data type %s", sensor['data'])
+            raise ValueError("Unknown sensor data type %s" % sensor['data'])
+    logging.info("Got data for sensor '%s' in %s seconds", sensor['name'], sensor_span.seconds)
+    return data
+
+
+def get_sensor_data_from_pool(function, timestamps, sensor, pool):
+    """
+    Get the data of a sensor, database sensors check out a connection of the pool
+
+    :param function: get_sensor_data or get_sensor_data_batch
+    :param timestamps: the timestamp (or timestamps) passed to the function
+    :param sensor: the sensor to get the data from
+    :param pool: the database connections
+    :type function: function
+    :type timestamps: datetime.datetime|list[datetime.datetime]
+    :type sensor: dict
+    :type pool: ConnectionPool
+
+    :return: the result of the function
+    """
+    if (sensor['data'] == 'database'):
+        with pool.connection() as db:
+            return function(timestamps, sensor, db)
+    return function(timestamps, sensor)
+
+
+def get_all_sensor_data(function, capture_times, db=None, pool=None):
+    """
+    Get the data of all sensors. If a pool is given every sensor is retrieved on its own thread, so slow file
+    access doesn't hold up the database sensors and the other way round
+
+    :param function: get_sensor_data or get_sensor_data_batch
+    :param capture_times: the timestamp (or timestamps) passed to the function for every sensor name
+    :param db: the database used if there is no pool
+    :param pool: the database connections shared by the threads
+    :type function: function
+    :type capture_times: dict
+    :type db: Backend
+    :type pool: ConnectionPool
+
+    :return: the result of the function for every sensor name
+    :rtype: dict
+    """
+    if (pool is None):
+        return dict((sensor['name'], function(capture_times[sensor['name']], sensor, db)) for sensor in sensors)
+
+    with ThreadPoolExecutor(max_workers=len(sensors)) as executor:
+        futures = [(sensor['name'], executor.submit(get_sensor_data_from_pool, function,
+                                                    capture_times[sensor['name']], sensor, pool))
+                   for sensor in sensors]
+        return dict((name, future.result()) for name, future in futures)
+
+
+def increase_fetch_limit():
+    """
+    Increase the fetch limit in case the speed data gathered from the database isn't enough
+
+    :raises ValueError: if the max fetch limit has already been reached
+    """
+    global fetch_limit
+    if (fetch_limit == max_fetch_limit):
+        logging.critical("Max fetch limit reached. Not enough speed data")
+        raise ValueError("Max fetch limit reached. Not enough speed data")
+    logging.debug("Not enough data in %d entries, increasing fetch_limit", fetch_limit)
+    fetch_limit += fetch_limit_increase_rate
+    if (fetch_limit > max_fetch_limit):
+        fetch_limit = max_fetch_limit
+
+
+def create_speed_histories():
+    """
+    :return: empty speed histories of the lines. The speeds are only merged into segments if the time offsets
+        are interpolated, the other offsets depend on the times of all speeds
+    :rtype: SpeedHistories
+    """
+    return SpeedHistories(lines, speed_tolerance if (interpolate_time_offsets) else None)
+
+
+def get_capture_times(targets, lengths, profiles):
+    """
+    Compute when the material of every target was at the position of every sensor
+
+    :param targets: tuples (moment the material was at the position or None for the newest speed data, position)
+    :param lengths: all line lengths
+    :param profiles: the speed profiles of all lines
+    :type targets: list[tuple[datetime.datetime, float]]
+    :type lengths: list[float]
+    :type profiles: list[SpeedProfile]
+
+    :raises IndexError: if there isn't enough speed data
+
+    :return: the capture times of every target for every sensor name (None if the sensor is behind the position)
+    :rtype: dict[str, list[datetime.datetime]]
+    """
+    capture_times = dict((sensor['name'], []) for sensor in sensors)
+    with metrics.span("time_offsets"):
+        for moment, position in targets:
+            for sensor in sensors:
+                time_offset = get_time_offset_multiple_lines_profiles(sensor['position'], position, lengths,
+                                                                      profiles, moment, interpolate_time_offsets)
+                if (time_offset is None):
+                    capture_times[sensor['name']].append(None)
+                elif (interpolate_time_offsets and moment is not None):
+                    capture_times[sensor['name']].append(moment - time_offset)
                 else:
-                    sensor_data.append(list(row.items())[0][1])
-                break
-            previous = row
+                    capture_times[sensor['name']].append(get_reference_time(profiles, moment) - time_offset)
+    return capture_times
 
-    else:
-        logging.critical("Unknown sensor data type %s" % sensor['data'])
-        raise ValueError("Unknown sensor data type %s" % sensor['data'])
-    logging.info("Got data for sensor '%s' in %s seconds" % (sensor['name'], str(time.time() - start)))
 
-    if len(sensor_data) == 1:
-        return sensor_data[0]
+def get_batch_capture_times(db, moments=None, positions=None, histories=None):
+    """
+    Compute when the material of many targets was at the position of every sensor (see synchronize_batch).
+    More speeds are fetched if the histories are too short
+
+    :param db: the database
+    :param moments: the moments the material was at current_position (or at the positions)
+    :param positions: the positions of the material
+    :param histories: the speed histories to reuse from previous calls
+    :type db: Backend
+    :type moments: list[datetime.datetime]
+    :type positions: list[float]
+    :type histories: SpeedHistories
+
+    :raises ValueError: if there isn't enough speed data within max_fetch_limit
+
+    :return: the capture times of the targets for every sensor name (see get_capture_times)
+    :rtype: dict
+    """
+    if (moments is not None and positions is not None):
+        targets = list(zip(moments, positions))
+    elif (moments is not None):
+        targets = [(moment, current_position) for moment in moments]
     else:
-        return sensor_data
+        targets = [(None, position) for position in positions]
+
+    lengths = [f["length"] for f in lines["lines"]]
+    if (histories is None):
+        histories = create_speed_histories()
+    histories.fetch(db, fetch_limit)
+
+    capture_times = None
+    while capture_times is None:
+        try:
+            capture_times = get_capture_times(targets, lengths, histories.profiles)
+        except IndexError:
+            increase_fetch_limit()
+            histories.fetch(db, fetch_limit)
+    return capture_times
+
+
+def get_batch_records(capture_times, db=None, pool=None, function=get_sensor_data_batch):
+    """
+    :param capture_times: the capture times of the targets for every sensor name (see get_batch_capture_times)
+    :param db: the database used if there is no pool
+    :param pool: the database connections to get the data of the sensors concurrently (see get_all_sensor_data)
+    :param function: get_sensor_data_batch or a function with the same parameters
+    :type capture_times: dict
+    :type db: Backend
+    :type pool: ConnectionPool
+    :type function: function
+
+    :return: one record (sensor name -> sensor data) per target
+    :rtype: list[dict]
+    """
+    records = [{} for _ in next(iter(capture_times.values()), [])]
+    for name, sensor_data in get_all_sensor_data(function, capture_times, db, pool).items():
+        for record, data in zip(records, sensor_data):
+            record[name] = data
+    return records
+
+
+def synchronize_batch(db, moments=None, positions=None, histories=None, pool=None):
+    """
+    Get the data of all sensors for many targets at once. Every sensor's data is only walked through once.
+    The targets are either the moments the material was at current_position, the positions of the material
+    at the time of the newest speed data or both (the material was at the position at the moment)
+
+    :param db: the database
+    :param moments: the moments the material was at current_position (or at the positions)
+    :param positions: the positions of the material
+    :param histories: the speed histories to reuse from previous calls
+    :param pool: the database connections to get the data of the sensors concurrently (see get_all_sensor_data)
+    :type db: Backend
+    :type moments: list[datetime.datetime]
+    :type positions: list[float]
+    :type histories: SpeedHistories
+    :type pool: ConnectionPool
+
+    :return: one record (sensor name -> sensor data) per target
+    :rtype: list[dict]
+    """
+    capture_times = get_batch_capture_times(db, moments, positions, histories)
+    return get_batch_records(capture_times, db, pool)
 
 
 # ========
@@ -500,12 +1215,20 @@ def init_logger():
     logger.addHandler(ch)
 
 
-if (__name__ == "__main__"):
-    init_logger()
-    now = time.time()
-    logging.debug("Application started")
+def connect_database():
+    """
+    Open the backend of the database (see backend)
+
+    :return: the backend or None if it failed
+    :rtype: Backend
+    """
+    if (backend == 'local'):
+        logging.info("Replaying the tables exported to %s", local_data_path)
+        return LocalBackend(local_data_path)
+    if (backend == 'sqlite'):
+        logging.info("Connected to sqlite at %s", sqlite_path)
+        return SqliteBackend(sqlite_path)
 
-    # create mysql connection
     try:
         db = mysql.connector.connect(**mysql_config)
     except mysql.connector.Error as err:
@@ -515,44 +1238,82 @@ if (__name__ == "__main__"):
             logging.critical("Database does not exist")
         else:
             logging.critical(err)
+        return None
+
+    logging.info("Connected to mysql at %s@%s:%s/%s",
+                 mysql_config["user"], mysql_config["host"], mysql_config["port"], mysql_config['database'])
+    return MysqlBackend(db)
+
+
+def create_connection_pool(db):
+    """
+    Create the pool of database connections used to get the sensor data concurrently
+
+    :param db: an open backend that is added to the pool
+    :type db: Backend
+
+    :return: the pool
+    :rtype: ConnectionPool
+    """
+    if (backend == 'local'):
+        # the tables are only read, so all threads share them
+        pool = ConnectionPool(lambda: db, connection_pool_size)
+    elif (backend == 'sqlite'):
+        pool = ConnectionPool(lambda: SqliteBackend(sqlite_path), connection_pool_size)
     else:
-        logging.info("Connected to mysql at %s@%s:%s/%s" % (
-            mysql_config["user"], mysql_config["host"], mysql_config["port"], mysql_config['database']
-        ))
+        pool = ConnectionPool(lambda: MysqlBackend(mysql.connector.connect(**mysql_config)), connection_pool_size)
+    pool.add(db)
+    return pool
+
+
+if (__name__ == "__main__"):
+    init_logger()
+    now = time.time()
+    logging.debug("Application started")
 
+    # connect to the database
+    db = connect_database()
+    if (db is not None):
         # Get the speeds from the database
-        all_v = get_speeds(db)
+        speed_histories = create_speed_histories()
+        speed_histories.fetch(db, fetch_limit)
+        profiles = speed_histories.profiles
 
         # TODO probably adapt lengths in get_time_offset_multiple_lines so we don't need the line underneath?
         lengths = [f["length"] for f in lines["lines"]]
 
-        # optimize file names of analyser
-        reformat_analyser(analyser)
-
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         # !! important stuff happens here !!
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        sensor_data = {}
+        capture_times = {}
         for sensor in sensors:
 
             # get time offset
             time_offset = None
             while time_offset is None:
                 try:
-                    time_offset = get_time_offset_multiple_lines(sensor['position'], current_position, lengths,
-                                                                 all_v)
+                    with metrics.span("time_offsets"):
+                        time_offset = get_time_offset_multiple_lines_profiles(sensor['position'], current_position,
+                                                                              lengths, profiles,
+                                                                              interpolate=interpolate_time_offsets)
                 except IndexError as e:
-                    if (fetch_limit == max_fetch_limit):
-                        logging.critical("Max fetch limit reached. Not enough speed data")
-                        raise ValueError("Max fetch limit reached. Not enough speed data")
-                    logging.debug("Not enough data in %d entries, increasing fetch_limit" % fetch_limit)
-                    fetch_limit += fetch_limit_increase_rate
-                    if (fetch_limit > max_fetch_limit):
-                        fetch_limit = max_fetch_limit
-                    all_v = get_speeds(db)
-
-            time_of_sensor_capture = all_v[0][0]["datetime"] - time_offset
-            sensor_data[sensor['name']] = get_sensor_data(time_of_sensor_capture, sensor, db)
-        db.close()
-
-        logging.info("Program finished in %s seconds" % str(time.time() - now))
+                    increase_fetch_limit()
+                    speed_histories.fetch(db, fetch_limit)
+
+            capture_times[sensor['name']] = get_reference_time(profiles) - time_offset
+
+        if (concurrent_retrieval):
+            pool = create_connection_pool(db)
+            sensor_data = get_all_sensor_data(get_sensor_data, capture_times, pool=pool)
+            pool.close()
+        else:
+            sensor_data = get_all_sensor_data(get_sensor_data, capture_times, db)
+            db.close()
+
+        if (record_directory is not None):
+            sink = ColumnarSink(record_directory, sensors)
+            sink.write({'time': get_reference_time(profiles), 'sensors': sensor_data})
+            sink.close()
+
+        logging.info("Program finished in %s seconds", time.time() - now)
+        metrics.export()
@@ -12,9 +12,39 @@ structure of v_all:
 
 structure of l:
 [length_1 in m, length_2 in m, ...]
+
+The SpeedProfile of a line holds the same speeds as v with the cumulative travelled distance, so the
+time offsets can be found with a binary search instead of walking through v. The speeds stay constant for long
+stretches, so a profile can merge consecutive speeds within a tolerance into segments of constant speed.
+The interpolated time offsets are computed on the segments directly.
 """
+import bisect
 import datetime
 
+epoch = datetime.datetime(1970, 1, 1)
+
+
+def to_microseconds(timestamp):
+    """
+    :param timestamp: the datetime
+    :type timestamp: datetime.datetime
+
+    :return: the microseconds since epoch
+    :rtype: int
+    """
+    return (timestamp - epoch) // datetime.timedelta(microseconds=1)
+
+
+def from_microseconds(microseconds):
+    """
+    :param microseconds: the microseconds since epoch
+    :type microseconds: int
+
+    :return: the datetime
+    :rtype: datetime.datetime
+    """
+    return epoch + datetime.timedelta(microseconds=microseconds)
+
 
 def get_time_offset_single_line(delta_p, v, offset=datetime.timedelta(0)):
     """
@@ -100,3 +130,332 @@ def get_time_offset_multiple_lines(p_1, p_2, l, all_v):
         time_offset += get_time_offset_single_line(delta_p, temp_v)
 
     return time_offset
+
+
+class SpeedProfile(object):
+    """
+    The speeds of a single line with the distance travelled since the newest speed
+
+    times: the times of the speeds in microseconds since epoch (descending like v)
+    speeds: the speeds in m/s, speeds[k] is the speed between times[k + 1] and times[k]
+    distances: distances[k] is the distance travelled between times[0] and times[k]
+    counts: counts[k] is the amount of speeds merged into the segment from times[k + 1] to times[k]
+    samples: the amount of speeds added (including the merged ones)
+    """
+    __slots__ = ('times', 'speeds', 'distances', 'counts', 'samples', 'tolerance', '_negated_times', '_monotonic')
+
+    def __init__(self, v, tolerance=None):
+        """
+        :param v: the speeds of the line
+        :param tolerance: consecutive speeds differing by at most the tolerance (in m/s) from the first speed of
+            their segment are merged into the segment. None to keep every speed (required for the offsets that
+            aren't interpolated, as they depend on the times of all speeds)
+        :type v: list[dict]
+        :type tolerance: float
+        """
+        self.times = []
+        self.speeds = []
+        self.distances = []
+        self.counts = []
+        self.samples = 0
+        self.tolerance = tolerance
+        self._negated_times = []
+        self._monotonic = True
+        self.extend(v)
+
+    def __len__(self):
+        return len(self.times)
+
+    def extend(self, v):
+        """
+        Add older speeds to the profile
+
+        :param v: the speeds older than the oldest speed of the profile (descending)
+        :type v: list[dict]
+        """
+        self.extend_raw([to_microseconds(e['datetime']) for e in v], [e['speed'] for e in v])
+
+    def extend_raw(self, times, speeds):
+        """
+        Add older speeds to the profile
+
+        :param times: the times of the speeds in microseconds since epoch (descending)
+        :param speeds: the speeds in m/s
+        :type times: collections.Sequence[int]
+        :type speeds: collections.Sequence[float]
+        """
+        for time, speed in zip(times, speeds):
+            self._append(time, speed, 1)
+
+    def _append(self, time, speed, count):
+        if (len(self.times) == 0):
+            self.distances.append(0.0)
+        else:
+            if (self.tolerance is not None and len(self.times) >= 2 and
+                    abs(self.speeds[-1] - self.speeds[-2]) <= self.tolerance):
+                # the oldest speed continues the segment before it, so its segment ends at the new time
+                self.counts[-2] += self.counts[-1]
+                del self.times[-1]
+                del self.speeds[-1]
+                del self.distances[-1]
+                del self.counts[-1]
+                del self._negated_times[-1]
+            self.distances.append(self.distances[-1] + self.speeds[-1] * (self.times[-1] - time) / 1e6)
+            self._monotonic = self._monotonic and self.speeds[-1] >= 0
+        self.times.append(time)
+        self.speeds.append(speed)
+        self.counts.append(count)
+        self.samples += count
+        self._negated_times.append(-time)
+
+    def index_at(self, time):
+        """
+        :param time: the time in microseconds since epoch
+        :type time: int
+
+        :return: the position of the newest speed at or before the time (len(self) if there is none)
+        :rtype: int
+        """
+        return bisect.bisect_left(self._negated_times, -time)
+
+    def distance_at(self, time):
+        """
+        :param time: the time in microseconds since epoch (not newer than the newest speed)
+        :type time: float
+
+        :raises IndexError: if the time is older than the oldest speed
+
+        :return: the distance travelled between the newest speed and the time
+        :rtype: float
+        """
+        j = self.index_at(time)
+        if (j == len(self)):
+            raise IndexError("No speed data at %s" % time)
+        if (self.times[j] == time or j == 0):
+            return self.distances[j]
+        return self.distances[j - 1] + self.speeds[j - 1] * (self.times[j - 1] - time) / 1e6
+
+    def time_at(self, distance):
+        """
+        :param distance: the distance travelled since the newest speed
+        :type distance: float
+
+        :raises IndexError: if the distance hasn't been travelled in the time of the speeds
+
+        :return: the time in microseconds since epoch the distance had been travelled
+        :rtype: float
+        """
+        if (self._monotonic):
+            j = bisect.bisect_left(self.distances, distance)
+        else:
+            j = 0
+            while (j < len(self) and self.distances[j] < distance):
+                j += 1
+        if (j >= len(self)):
+            raise IndexError("Not enough speed data to travel %f m" % distance)
+        if (j == 0 or self.distances[j] == distance):
+            return self.times[j]
+        return self.times[j - 1] - (distance - self.distances[j - 1]) / self.speeds[j - 1] * 1e6
+
+    def reached_at(self, distance, start):
+        """
+        :param distance: the distance travelled since the newest speed
+        :param start: the position of the speed to start searching at
+        :type distance: float
+        :type start: int
+
+        :raises IndexError: if the distance hasn't been travelled in the time of the speeds
+
+        :return: the position of the first speed after start the distance has been travelled at
+        :rtype: int
+        """
+        if (self._monotonic):
+            j = bisect.bisect_left(self.distances, distance, start + 1)
+        else:
+            j = start + 1
+            while (j < len(self) and self.distances[j] < distance):
+                j += 1
+        if (j >= len(self)):
+            raise IndexError("Not enough speed data to travel %f m" % distance)
+        return j
+
+    def prepend_raw(self, times, speeds):
+        """
+        Add newer speeds to the profile. All distances are recomputed, as they start at the newest speed
+
+        :param times: the times of the speeds in microseconds since epoch (descending)
+        :param speeds: the speeds in m/s
+        :type times: collections.Sequence[int]
+        :type speeds: collections.Sequence[float]
+        """
+        old = list(zip(self.times, self.speeds, self.counts))
+        self.truncate(0)
+        self.extend_raw(times, speeds)
+        for time, speed, count in old:
+            self._append(time, speed, count)
+
+    def truncate(self, length):
+        """
+        Remove all but the newest speeds
+
+        :param length: the amount of speeds to keep (including the merged ones)
+        :type length: int
+        """
+        # keep the speeds up to the first speed reaching the length
+        kept = min(length, len(self.times))
+        if (kept > 0):
+            merged = 0
+            kept = 1
+            while (kept < len(self.times) and merged + kept < length):
+                merged += self.counts[kept - 1] - 1
+                kept += 1
+        if (kept < len(self.times)):
+            del self.times[kept:]
+            del self.speeds[kept:]
+            del self.distances[kept:]
+            del self.counts[kept:]
+            del self._negated_times[kept:]
+            if (kept > 0):
+                # the speeds merged into the segment after the oldest speed are removed
+                self.counts[-1] = 1
+        self.samples = sum(self.counts)
+        self._monotonic = all(speed >= 0 for speed in self.speeds[:-1])
+
+
+def build_speed_profiles(all_v, tolerance=None):
+    """
+    :param all_v: all line speeds
+    :param tolerance: the tolerance to merge speeds into segments with (see SpeedProfile)
+    :type all_v: list[list[dict]]
+    :type tolerance: float
+
+    :return: the speed profiles of all lines
+    :rtype: list[SpeedProfile]
+    """
+    return [SpeedProfile(v, tolerance) for v in all_v]
+
+
+def get_reference_time(profiles, moment=None):
+    """
+    :param profiles: the speed profiles of all lines
+    :param moment: the moment to get the reference time for (None for the newest speed)
+    :type profiles: list[SpeedProfile]
+    :type moment: datetime.datetime
+
+    :raises IndexError: if there is no speed before the moment
+
+    :return: the time of the newest speed of the first line at or before the moment
+    :rtype: datetime.datetime
+    """
+    i = 0
+    if (moment is not None):
+        i = profiles[0].index_at(to_microseconds(moment))
+    return from_microseconds(profiles[0].times[i])
+
+
+def get_time_offset_single_line_profile(delta_p, profile, start=0, interpolate=False):
+    """
+    :param delta_p: the distance
+    :param profile: the speed profile of the line
+    :param start: the position of the speed to start at
+    :param interpolate: False to return the same results as get_time_offset_single_line,
+        True to interpolate the exact time the distance has been travelled
+    :type delta_p: float
+    :type profile: SpeedProfile
+    :type start: int
+    :type interpolate: bool
+
+    :raises IndexError: if there isn't enough speed data
+
+    :return: the offset in microseconds from the speed at start until the distance was travelled
+    :rtype: float
+    """
+    if (interpolate):
+        return profile.times[start] - profile.time_at(profile.distances[start] + delta_p)
+
+    j = profile.reached_at(profile.distances[start] + delta_p, start)
+    offset = profile.times[start] - profile.times[j]
+    if (j - start >= 2):
+        # get_time_offset_single_line doesn't add the second to last interval to its result
+        offset -= profile.times[j - 2] - profile.times[j - 1]
+    return offset
+
+
+def get_time_offset_multiple_lines_profiles(p_1, p_2, l, profiles, moment=None, interpolate=False):
+    """
+    Same as get_time_offset_multiple_lines with a binary search in the speed profiles
+
+    :param p_1: The sensor position in m since start of first line
+    :param p_2: The current position in m since start of first line
+    :param l: all line lengths
+    :param profiles: the speed profiles of all lines
+    :param moment: the moment the material was at p_2 (None for the time of the newest speed)
+    :param interpolate: True to interpolate between the speeds (see get_time_offset_single_line_profile)
+    :type p_1: float
+    :type p_2: float
+    :type l: list[float]
+    :type profiles: list[SpeedProfile]
+    :type moment: datetime.datetime
+    :type interpolate: bool
+
+    :raises IndexError: if there isn't enough speed data
+
+    :return: the time when the current position should have been at the requested sensor position. The offset is
+        measured from the moment itself if interpolate is set (merged speeds have no times to snap to) and from
+        the newest speed at or before the moment otherwise (see get_reference_time)
+    :rtype: datetime.timedelta
+    """
+    sensor_line = line_id(p_1, l)
+    current_line = line_id(p_2, l)
+
+    if (sensor_line > current_line):
+        # something broke up. That's not possible
+        return
+
+    # the newest speed of every line at the moment
+    starts = [0] * len(profiles)
+    if (moment is not None):
+        starts = [profile.index_at(to_microseconds(moment)) for profile in profiles]
+        if (any(start >= len(profile) for start, profile in zip(starts, profiles))):
+            raise IndexError("No speed data before %s" % moment)
+
+    moment_time = None
+    if (interpolate and moment is not None):
+        moment_time = to_microseconds(moment)
+
+    if (sensor_line == current_line):
+        profile = profiles[current_line]
+        if (moment_time is not None):
+            return datetime.timedelta(microseconds=round(
+                moment_time - profile.time_at(profile.distance_at(moment_time) + p_2 - p_1)))
+        return datetime.timedelta(microseconds=round(
+            get_time_offset_single_line_profile(p_2 - p_1, profile, starts[current_line], interpolate)))
+
+    time_offset = 0
+
+    first_distance = sum(l[:sensor_line + 1]) - p_1
+    last_distance = p_2 - sum(l[:current_line])
+
+    for i in reversed(range(sensor_line, current_line + 1)):
+        profile = profiles[i]
+        delta_p = l[i]
+        if i == sensor_line:
+            delta_p = first_distance
+        elif i == current_line:
+            delta_p = last_distance
+
+        if (moment_time is not None):
+            start_time = moment_time - time_offset
+        else:
+            start_time = profile.times[starts[i]] - time_offset
+        if (interpolate):
+            start_distance = profile.distance_at(start_time)
+            time_offset += start_time - profile.time_at(start_distance + delta_p)
+        else:
+            # skip time_offset of the line
+            start = profile.index_at(start_time)
+            if (start == len(profile)):
+                raise IndexError("No speed data at %s" % start_time)
+            time_offset += get_time_offset_single_line_profile(delta_p, profile, start)
+
+    return datetime.timedelta(microseconds=round(time_offset))